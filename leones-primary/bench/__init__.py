@@ -0,0 +1 @@
+"""Benchmark y datos sintéticos de leones-primary (ver bench/__main__.py)."""
@@ -0,0 +1,155 @@
+"""Benchmark reproducible del primario y las réplicas.
+
+uso (desde leones-primary/):
+    python -m bench                       # mide y compara con bench/baseline.json
+    python -m bench --save-baseline       # mide y guarda el resultado como baseline
+    python -m bench --posts 5000 --requests 500 --concurrency 16
+
+Pasos: siembra una base nueva en un directorio temporal, levanta
+--replicas procesos replica_server.py y les envía todo el log por
+/replicate, corre las rutas del primario con el test client de Flask
+(secuencial) y por HTTP (concurrente), y por último las lecturas de la API
+contra las réplicas. Las consultas SQL por request salen del encabezado
+X-SQL-Queries que agrega metrics.py. Sale con 1 si hay regresiones.
+"""
+import argparse
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# las rutas del primario (db/, static/) son relativas al directorio actual
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+from bench import report  # noqa: E402
+from bench.scenarios import (  # noqa: E402
+    PrimaryScenarios, ReplicaProcess, mark_replicated, replay_events,
+    run_primary_http, run_replica_reads, run_test_client, serve_in_thread, wait_until,
+)
+from bench.seed import add_arguments, seed, seed_options  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(REPO_DIR, "bench", "baseline.json")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark de leones-primary")
+    add_arguments(parser)
+    parser.add_argument("--requests", type=int, default=200, help="requests por ruta")
+    parser.add_argument("--concurrency", type=int, default=8, help="hilos en las fases HTTP")
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--replicate-batch", type=int, default=200, help="eventos por POST /replicate")
+    parser.add_argument("--skip-http", action="store_true", help="sólo test client (sin servidores HTTP)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=report.DEFAULT_TOLERANCE,
+                        help="crecimiento de p95 tolerado (0.2 = 20%%)")
+    parser.add_argument("--output", help="archivo JSON donde guardar los resultados")
+    parser.add_argument("--workdir", help="directorio de trabajo (por defecto uno temporal)")
+    parser.add_argument("--keep", action="store_true", help="no borrar el directorio de trabajo")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="leones-bench-"))
+    os.makedirs(os.path.join(workdir, "db"), exist_ok=True)
+    db_path = os.path.join(workdir, "db", "primary.db")
+    if os.path.exists(db_path):
+        raise SystemExit(f"{db_path} ya existe: el benchmark necesita una base nueva")
+    rng = random.Random(args.seed)
+    recorder = report.Recorder()
+    replicas = []
+    try:
+        print(f"[bench] sembrando {db_path} ...")
+        data = seed(db_path, **seed_options(args))
+        print(f"[bench] {data['users']} usuarios, {data['posts']} posts, {data['reactions']} reacciones, "
+              f"{data['comments']} comentarios ({data['seconds']} s)")
+
+        if not args.skip_http:
+            for i in range(args.replicas):
+                replicas.append(ReplicaProcess(f"bench{i + 1}", workdir).start())
+            print(f"[bench] replicando {data['last_event_id']} eventos en {len(replicas)} réplicas ...")
+            replay_events(db_path, replicas, recorder, args.replicate_batch)
+            mark_replicated(db_path, replicas, data["last_event_id"])
+
+        # el primario se importa recién ahora: abre la base sembrada y replica a las réplicas de arriba
+        os.environ["REPLICAS"] = ",".join(r.url for r in replicas)
+        os.environ.setdefault("SNAPSHOT_INTERVAL", str(10 ** 9))
+        os.chdir(workdir)
+        import primary_server
+
+        scenarios = PrimaryScenarios(data, rng)
+        print(f"[bench] primario (test client): {args.requests} requests por ruta ...")
+        run_test_client(primary_server.app, scenarios, recorder, args.requests)
+
+        if not args.skip_http:
+            base_url, server = serve_in_thread(primary_server.app)
+            print(f"[bench] primario (HTTP, {args.concurrency} hilos) ...")
+            run_primary_http(base_url, scenarios, recorder, args.requests, args.concurrency)
+            server.shutdown()
+
+            target = scenarios.last_event_id
+            if not wait_until(lambda: all(r.last_event_id() >= target for r in replicas), 30):
+                print("[bench] aviso: las réplicas no alcanzaron al primario antes de medir")
+            print(f"[bench] réplicas (HTTP, {args.concurrency} hilos) ...")
+            run_replica_reads(replicas, data, rng, recorder, args.requests, args.concurrency)
+    finally:
+        for replica in replicas:
+            replica.stop()
+        os.chdir(REPO_DIR)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "params": {
+            **seed_options(args),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "replicas": 0 if args.skip_http else args.replicas,
+            "replicate_batch": args.replicate_batch,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "routes": recorder.summary(),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    print()
+    print(report.format_table(results["routes"]))
+
+    if args.output:
+        report.save_results(args.output, results)
+    if args.save_baseline:
+        report.save_results(args.baseline, results)
+        print(f"\n[bench] baseline guardado en {args.baseline}")
+        return 0
+
+    baseline = report.load_baseline(args.baseline)
+    if baseline is None:
+        print(f"\n[bench] sin baseline en {args.baseline} (usar --save-baseline para crearlo)")
+        return 0
+    regressions, warnings = report.compare(results, baseline, args.tolerance)
+    for w in warnings:
+        print(f"[bench] aviso: {w}")
+    if regressions:
+        print("\n[bench] REGRESIONES respecto del baseline:")
+        for r in regressions:
+            print(f"  - {r}")
+        return 1
+    print(f"\n[bench] sin regresiones respecto del baseline ({baseline.get('created_at')})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""Percentiles por ruta, tabla de resultados y comparación contra un baseline guardado."""
+import json
+import math
+import threading
+
+# Una ruta empeora si su p95 crece más que esta fracción (y más que MIN_DELTA_MS)
+DEFAULT_TOLERANCE = 0.20
+MIN_DELTA_MS = 2.0
+# ...o si hace más consultas SQL por request que en el baseline
+QUERY_TOLERANCE = 0.5
+
+
+def percentile(sorted_values, pct):
+    """Percentil por rango más cercano de una lista ya ordenada."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """Latencias (ms), errores y consultas SQL por ruta; seguro entre hilos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+
+    def _route(self, name):
+        return self.routes.setdefault(name, {
+            "latencies": [], "queries": [], "errors": 0, "elapsed": 0.0, "units": 0,
+        })
+
+    def add(self, name, ms, queries=None, ok=True, units=1):
+        """`units` cuenta lo que procesó el request (p. ej. eventos en /replicate)."""
+        with self._lock:
+            route = self._route(name)
+            route["latencies"].append(ms)
+            route["units"] += units
+            if queries is not None:
+                route["queries"].append(queries)
+            if not ok:
+                route["errors"] += 1
+
+    def set_elapsed(self, name, seconds):
+        with self._lock:
+            self._route(name)["elapsed"] = seconds
+
+    def summary(self):
+        out = {}
+        with self._lock:
+            for name, r in self.routes.items():
+                lat = sorted(r["latencies"])
+                n = len(lat)
+                elapsed = r["elapsed"] or sum(lat) / 1000
+                out[name] = {
+                    "requests": n,
+                    "errors": r["errors"],
+                    "throughput": round(n / elapsed, 1) if elapsed else None,
+                    "units_per_s": round(r["units"] / elapsed, 1) if elapsed and r["units"] != n else None,
+                    "mean_ms": round(sum(lat) / n, 3) if n else None,
+                    "p50_ms": _round(percentile(lat, 50)),
+                    "p95_ms": _round(percentile(lat, 95)),
+                    "p99_ms": _round(percentile(lat, 99)),
+                    "max_ms": _round(lat[-1] if lat else None),
+                    "queries_mean": round(sum(r["queries"]) / len(r["queries"]), 2) if r["queries"] else None,
+                    "queries_max": max(r["queries"]) if r["queries"] else None,
+                }
+        return out
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+
+def _fmt(value, spec="{:.2f}"):
+    return "-" if value is None else spec.format(value)
+
+
+def format_table(routes):
+    header = f"{'ruta':<32}{'n':>6}{'err':>5}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'sql':>7}{'sql max':>8}"
+    lines = [header, "-" * len(header)]
+    for name, r in routes.items():
+        lines.append(
+            f"{name:<32}{r['requests']:>6}{r['errors']:>5}{_fmt(r['throughput'], '{:.1f}'):>9}"
+            f"{_fmt(r['p50_ms']):>9}{_fmt(r['p95_ms']):>9}{_fmt(r['p99_ms']):>9}{_fmt(r['max_ms']):>9}"
+            f"{_fmt(r['queries_mean'], '{:.1f}'):>7}{_fmt(r['queries_max'], '{}'):>8}"
+        )
+        if r.get("units_per_s"):
+            lines.append(f"{'':<32}  ({r['units_per_s']:.1f} eventos/s)")
+    lines.append("(latencias en ms; sql = consultas por request)")
+    return "\n".join(lines)
+
+
+# -------------------------------
+# Baseline
+# -------------------------------
+def load_baseline(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_results(path, results):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE, min_delta_ms=MIN_DELTA_MS):
+    """(regresiones, avisos) de `results` frente a `baseline` (mismo formato)."""
+    regressions, warnings = [], []
+    if baseline.get("params") != results.get("params"):
+        warnings.append("el baseline se midió con otros parámetros: la comparación es orientativa")
+    base_routes = baseline.get("routes", {})
+    for name, r in results["routes"].items():
+        base = base_routes.get(name)
+        if base is None:
+            warnings.append(f"{name}: no está en el baseline")
+            continue
+        if r["p95_ms"] is not None and base.get("p95_ms"):
+            delta = r["p95_ms"] - base["p95_ms"]
+            if delta > min_delta_ms and r["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: p95 {base['p95_ms']:.2f} -> {r['p95_ms']:.2f} ms (+{delta / base['p95_ms']:.0%})"
+                )
+        if r["queries_mean"] is not None and base.get("queries_mean") is not None:
+            if r["queries_mean"] > base["queries_mean"] + QUERY_TOLERANCE:
+                regressions.append(
+                    f"{name}: consultas por request {base['queries_mean']} -> {r['queries_mean']}"
+                )
+        if r["errors"] > base.get("errors", 0):
+            regressions.append(f"{name}: errores {base.get('errors', 0)} -> {r['errors']}")
+    return regressions, warnings
@@ -0,0 +1,294 @@
+"""Escenarios del benchmark: rutas del primario (test client o HTTP) y réplicas por HTTP."""
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import db_utils
+from bench.seed import PASSWORD, WORDS
+from replication import encode_batch, secret_headers
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+XHR = {"X-Requested-With": "XMLHttpRequest"}
+
+# Posts "calientes" sobre los que caen las reacciones y comentarios
+HOT_POSTS = 50
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until(fn, timeout, interval=0.1):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if fn():
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(interval)
+    return False
+
+
+# -------------------------------
+# Primario: rutas de la aplicación
+# -------------------------------
+class PrimaryScenarios:
+    """Un request de cada ruta por llamada; `client` es un test client o un HttpClient."""
+
+    def __init__(self, data, rng):
+        self.data = data
+        self.rng = rng
+        self.last_event_id = data["last_event_id"]
+
+    def _hot_post(self):
+        return self.rng.choice(self.data["post_ids"][-HOT_POSTS:])
+
+    def _track(self, resp):
+        event_id = resp.headers.get("X-Event-Id")
+        if event_id:
+            self.last_event_id = max(self.last_event_id, int(event_id))
+        return resp
+
+    def index(self, anon, user):
+        return anon.get("/")
+
+    def index_user(self, anon, user):
+        return user.get("/")
+
+    def profile(self, anon, user):
+        return anon.get(f"/profile/{self.rng.choice(self.data['usernames'])}")
+
+    def reactions_summary(self, anon, user):
+        # un cliente que sondea cada pocos segundos viene unos cuantos eventos atrás
+        since = max(0, self.last_event_id - self.rng.randint(0, 50))
+        return self._track(anon.get(f"/api/reactions_summary?since={since}"))
+
+    def react_post(self, anon, user):
+        reaction = self.rng.choice(("like", "love", "wow", "sad", "angry"))
+        return self._track(user.post(f"/posts/{self._hot_post()}/react",
+                                     data={"reaction_type": reaction}, headers=XHR))
+
+    def comment_post(self, anon, user):
+        return self._track(user.post(f"/posts/{self._hot_post()}/comment",
+                                     data={"content": "bench", "parent_comment_id": ""}, headers=XHR))
+
+    ROUTES = ("index", "index_user", "profile", "reactions_summary", "react_post", "comment_post")
+
+
+def login(client, username, attempts=20):
+    for _ in range(attempts):
+        resp = client.post("/login", data={"username": username, "password": PASSWORD})
+        # 503: el pool de hash de contraseñas está saturado (muchos hilos entrando a la vez)
+        if resp.status_code != 503:
+            break
+        time.sleep(float(resp.headers.get("Retry-After", 1)))
+    if resp.status_code not in (200, 302):
+        raise RuntimeError(f"login de {username} falló: {resp.status_code}")
+    return client
+
+
+def status_ok(resp):
+    return resp.status_code < 400 or resp.status_code == 304
+
+
+def sql_queries(resp):
+    """Sentencias SQL del request según metrics.py (X-SQL-Queries), si el servidor lo informa."""
+    value = resp.headers.get("X-SQL-Queries")
+    return int(value) if value is not None else None
+
+
+def run_test_client(app, scenarios, recorder, requests_per_route, warmup=5):
+    """Requests secuenciales con el test client de Flask (sin red ni servidor de por medio)."""
+    anon = app.test_client()
+    user = login(app.test_client(), scenarios.data["usernames"][0])
+    for route in PrimaryScenarios.ROUTES:
+        fn = getattr(scenarios, route)
+        for _ in range(warmup):
+            fn(anon, user)
+        started = time.perf_counter()
+        for _ in range(requests_per_route):
+            t0 = time.perf_counter()
+            resp = fn(anon, user)
+            recorder.add(route, (time.perf_counter() - t0) * 1000, sql_queries(resp), ok=status_ok(resp))
+        recorder.set_elapsed(route, time.perf_counter() - started)
+
+
+class HttpClient:
+    """Lo mínimo de la interfaz del test client sobre requests.Session."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def get(self, path, **kwargs):
+        return self.session.get(self.base_url + path, allow_redirects=False, timeout=30, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.session.post(self.base_url + path, allow_redirects=False, timeout=30, **kwargs)
+
+
+def serve_in_thread(app):
+    """Levanta `app` en un servidor HTTP local (hilo demonio) y devuelve su URL."""
+    from werkzeug.serving import make_server
+
+    # el log por request de werkzeug taparía el reporte
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    port = free_port()
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-http", daemon=True).start()
+    return f"http://127.0.0.1:{port}", server
+
+
+def run_concurrent(name, recorder, total, concurrency, make_state, request_fn):
+    """`total` requests repartidos en `concurrency` hilos; cada hilo con su propio estado."""
+    local = threading.local()
+
+    def one(_):
+        if not hasattr(local, "state"):
+            local.state = make_state()
+        t0 = time.perf_counter()
+        try:
+            resp = request_fn(local.state)
+        except requests.RequestException:
+            recorder.add(name, (time.perf_counter() - t0) * 1000, ok=False)
+            return
+        recorder.add(name, (time.perf_counter() - t0) * 1000, sql_queries(resp), ok=status_ok(resp))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    recorder.set_elapsed(name, time.perf_counter() - started)
+
+
+def run_primary_http(base_url, scenarios, recorder, requests_per_route, concurrency):
+    usernames = scenarios.data["usernames"]
+
+    def make_state():
+        # cada hilo con su propio usuario: las reacciones no se pisan entre sí
+        user = HttpClient(base_url)
+        login(user, usernames[threading.get_ident() % len(usernames)])
+        return HttpClient(base_url), user
+
+    for route in PrimaryScenarios.ROUTES:
+        fn = getattr(scenarios, route)
+        run_concurrent(f"http:{route}", recorder, requests_per_route, concurrency,
+                       make_state, lambda state: fn(*state))
+
+
+# -------------------------------
+# Réplicas
+# -------------------------------
+class ReplicaProcess:
+    """Un replica_server.py real en su propio proceso y puerto."""
+
+    def __init__(self, name, workdir):
+        self.name = name
+        self.workdir = workdir
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.proc = None
+
+    def start(self, timeout=30):
+        env = dict(os.environ, REPLICA_NAME=self.name, PORT=str(self.port))
+        # sin PRIMARY_URL: todo le llega por /replicate
+        env.pop("PRIMARY_URL", None)
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_DIR, "replica_server.py")],
+            cwd=self.workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        if not wait_until(lambda: requests.get(self.url + "/replica/status", timeout=1).ok, timeout):
+            self.stop()
+            raise RuntimeError(f"la réplica {self.name} no arrancó en {timeout} s")
+        return self
+
+    def last_event_id(self):
+        return requests.get(self.url + "/replica/status", timeout=5).json()["last_event_id"]
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+def replay_events(db_path, replicas, recorder, batch_size=200):
+    """Envía todo events_log a cada réplica por /replicate, en lotes como el ReplicationWorker."""
+    conn = db_utils.get_connection(db_path, readonly=True)
+    session = requests.Session()
+    for replica in replicas:
+        after = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, event_type, payload FROM events_log WHERE id > ? ORDER BY id LIMIT ?",
+                (after, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            body = encode_batch(rows)
+            t0 = time.perf_counter()
+            resp = session.post(replica.url + "/replicate", data=body,
+                                headers={"Content-Type": "application/json", **secret_headers()}, timeout=60)
+            recorder.add("replica:replicate", (time.perf_counter() - t0) * 1000, ok=resp.ok, units=len(rows))
+            if not resp.ok:
+                raise RuntimeError(f"{replica.name} rechazó el lote tras {after}: {resp.status_code} {resp.text[:200]}")
+            after = rows[-1]["id"]
+    conn.close()
+    return after
+
+
+def mark_replicated(db_path, replicas, event_id):
+    """Deja constancia en replication_state de que las réplicas ya tienen hasta `event_id`."""
+    conn = db_utils.get_connection(db_path)
+    conn.executemany(
+        """
+        INSERT INTO replication_state (replica_url, last_acked_event_id, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(replica_url) DO UPDATE SET last_acked_event_id = excluded.last_acked_event_id
+        """,
+        [(r.url, event_id) for r in replicas]
+    )
+    conn.commit()
+    conn.close()
+
+
+REPLICA_ROUTES = ("api_timeline", "api_profile", "api_post", "api_search", "api_reactions_summary")
+
+
+def run_replica_reads(replicas, data, rng, recorder, requests_per_route, concurrency):
+    """Lecturas de la API en las réplicas, repartidas en ronda entre todas."""
+    usernames, post_ids = data["usernames"], data["post_ids"]
+    last_event_id = data["last_event_id"]
+    paths = {
+        "api_timeline": lambda: "/api/timeline",
+        "api_profile": lambda: f"/api/profile/{rng.choice(usernames)}",
+        "api_post": lambda: f"/api/posts/{rng.choice(post_ids[-HOT_POSTS:])}",
+        # el vocabulario de seed.py es chico: cada término coincide con muchos posts y comentarios
+        "api_search": lambda: f"/api/search?q={rng.choice(WORDS)}+{rng.choice(WORDS)[:3]}",
+        "api_reactions_summary": lambda: f"/api/reactions_summary?since={max(0, last_event_id - rng.randint(0, 50))}",
+    }
+    counter = iter(range(10 ** 9))
+
+    def make_state():
+        return requests.Session()
+
+    for route in REPLICA_ROUTES:
+        path = paths[route]
+
+        def request_fn(session, path=path):
+            replica = replicas[next(counter) % len(replicas)]
+            return session.get(replica.url + path(), timeout=30)
+
+        run_concurrent(f"replica:{route}", recorder, requests_per_route, concurrency, make_state, request_fn)
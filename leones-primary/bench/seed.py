@@ -0,0 +1,174 @@
+"""Datos sintéticos para el benchmark: usuarios, posts, reacciones y comentarios anidados.
+
+Cada fila se inserta junto con su evento en events_log, igual que en los
+handlers del primario, así que las réplicas pueden recibir el mismo estado
+por /replicate. Con la misma semilla se obtiene siempre la misma base.
+
+uso: python -m bench.seed db/primary.db --users 200 --posts 2000
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from db_utils import get_connection, init_db
+from passwords import HASH_METHOD
+
+REACTION_TYPES = ("like", "love", "wow", "sad", "angry")
+USERNAME_PREFIX = "bench_"
+PASSWORD = "bench"
+
+WORDS = (
+    "leones partido gol equipo cancha entrenamiento hinchada estadio torneo "
+    "final jugada defensa ataque camiseta victoria derrota empate clásico"
+).split()
+
+
+def _text(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def _timestamp(dt):
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _log(cur, event_type, payload):
+    cur.execute(
+        "INSERT INTO events_log (event_type, payload) VALUES (?, ?)",
+        (event_type, json.dumps(payload))
+    )
+
+
+def seed(db_path, users=100, posts=1000, reactions=5, comments=4, reply_ratio=0.5,
+         max_depth=4, viral_posts=2, viral_comments=1000, seed=42):
+    """Llena `db_path` y devuelve un resumen (ids y contadores) para los escenarios.
+
+    `reactions` y `comments` son promedios por post; los `viral_posts` más
+    recientes reciben además `viral_comments` comentarios cada uno.
+    """
+    rng = random.Random(seed)
+    conn = get_connection(db_path)
+    init_db(conn)
+    cur = conn.cursor()
+    started = time.perf_counter()
+    # un solo hash: generarlo por usuario dominaría el tiempo de seeding
+    password_hash = generate_password_hash(PASSWORD, HASH_METHOD)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    cur.execute("BEGIN")
+    user_ids = []
+    usernames = []
+    for i in range(users):
+        username = f"{USERNAME_PREFIX}{i}"
+        created_at = _timestamp(now - timedelta(days=30))
+        cur.execute(
+            "INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+            (username, password_hash, created_at)
+        )
+        user_ids.append(cur.lastrowid)
+        usernames.append(username)
+        _log(cur, "CREATE_USER", {
+            "user_id": cur.lastrowid, "username": username, "role": "user", "created_at": created_at,
+        })
+
+    post_ids = []
+    n_reactions = n_comments = 0
+    for i in range(posts):
+        user_id = rng.choice(user_ids)
+        title, content = _text(rng, 4), _text(rng, 30)
+        # el más nuevo es el último: el timeline queda en orden de inserción inverso
+        created = now - timedelta(minutes=posts - i)
+        cur.execute(
+            "INSERT INTO posts (user_id, title, content, created_at) VALUES (?, ?, ?, ?)",
+            (user_id, title, content, _timestamp(created))
+        )
+        post_id = cur.lastrowid
+        post_ids.append(post_id)
+        _log(cur, "CREATE_POST", {
+            "post_id": post_id, "user_id": user_id, "title": title,
+            "content": content, "image_filename": None, "created_at": _timestamp(created),
+        })
+
+        for reactor in rng.sample(user_ids, min(users, rng.randint(0, 2 * reactions))):
+            reaction_type = rng.choice(REACTION_TYPES)
+            cur.execute(
+                "INSERT INTO reactions (user_id, post_id, reaction_type) VALUES (?, ?, ?)",
+                (reactor, post_id, reaction_type)
+            )
+            _log(cur, "REACT_POST", {"post_id": post_id, "user_id": reactor, "reaction_type": reaction_type})
+            n_reactions += 1
+
+        count = rng.randint(0, 2 * comments)
+        if i >= posts - viral_posts:
+            count += viral_comments
+        depth = {}
+        for k in range(count):
+            parents = [cid for cid, d in depth.items() if d < max_depth]
+            parent = rng.choice(parents) if parents and rng.random() < reply_ratio else None
+            user_id = rng.choice(user_ids)
+            content = _text(rng, 8)
+            comment_created = _timestamp(created + timedelta(seconds=k + 1))
+            cur.execute(
+                "INSERT INTO comments (user_id, post_id, content, parent_comment_id, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user_id, post_id, content, parent, comment_created)
+            )
+            comment_id = cur.lastrowid
+            depth[comment_id] = depth[parent] + 1 if parent else 1
+            _log(cur, "COMMENT_POST", {
+                "comment_id": comment_id, "post_id": post_id, "user_id": user_id,
+                "content": content, "parent_comment_id": parent, "created_at": comment_created,
+            })
+            n_comments += 1
+    conn.commit()
+
+    cur.execute("SELECT MAX(id) FROM events_log")
+    last_event_id = cur.fetchone()[0] or 0
+    conn.close()
+    return {
+        "users": users,
+        "posts": posts,
+        "reactions": n_reactions,
+        "comments": n_comments,
+        "user_ids": user_ids,
+        "usernames": usernames,
+        "post_ids": post_ids,
+        "viral_post_ids": post_ids[-viral_posts:] if viral_posts else [],
+        "last_event_id": last_event_id,
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--reactions", type=int, default=5, help="reacciones promedio por post")
+    parser.add_argument("--comments", type=int, default=4, help="comentarios promedio por post")
+    parser.add_argument("--reply-ratio", type=float, default=0.5, help="fracción de comentarios que son respuesta")
+    parser.add_argument("--max-depth", type=int, default=4, help="profundidad máxima de respuestas")
+    parser.add_argument("--viral-posts", type=int, default=2)
+    parser.add_argument("--viral-comments", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+
+
+def seed_options(args):
+    return {
+        "users": args.users, "posts": args.posts, "reactions": args.reactions,
+        "comments": args.comments, "reply_ratio": args.reply_ratio, "max_depth": args.max_depth,
+        "viral_posts": args.viral_posts, "viral_comments": args.viral_comments, "seed": args.seed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("db_path")
+    add_arguments(parser)
+    args = parser.parse_args()
+    summary = seed(args.db_path, **seed_options(args))
+    print(
+        f"{summary['users']} usuarios, {summary['posts']} posts, {summary['reactions']} reacciones, "
+        f"{summary['comments']} comentarios en {summary['seconds']} s (último evento {summary['last_event_id']})"
+    )
@@ -1,11 +1,84 @@
+import queue
 import sqlite3
+import threading
 from werkzeug.security import generate_password_hash
 
-def get_connection(db_path):
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+# WAL: los lectores no se bloquean detrás del escritor y varios procesos
+# (workers de gunicorn) pueden compartir el mismo archivo.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -16000",
+)
+
+# Clase de las conexiones nuevas (metrics.py la reemplaza por una instrumentada)
+_connection_factory = sqlite3.Connection
+
+
+def set_connection_factory(factory):
+    """Subclase de sqlite3.Connection para las conexiones que se abran desde ahora."""
+    global _connection_factory
+    _connection_factory = factory
+
+
+def get_connection(db_path, readonly=False):
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=5, factory=_connection_factory)
     conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
     return conn
 
+
+class ConnectionPool:
+    """Conexiones reutilizables: una de sólo lectura y otra para escrituras.
+
+    Un hilo toma una conexión libre la primera vez que llama a reader() o
+    writer() y la usa sólo él hasta release(), que la devuelve al pool. Los
+    servidores llaman a release() al terminar cada request: con un hilo nuevo
+    por request (app.run) no se reabre la conexión ni se repiten los PRAGMA.
+    Los hilos de fondo nunca la devuelven y se quedan con la suya.
+    """
+
+    def __init__(self, db_path, max_idle=32):
+        self.db_path = db_path
+        self._local = threading.local()
+        # LIFO: se reutiliza la conexión más reciente (caché de páginas caliente)
+        self._idle = {"reader": queue.LifoQueue(max_idle), "writer": queue.LifoQueue(max_idle)}
+
+    def _checkout(self, kind):
+        conn = getattr(self._local, kind, None)
+        if conn is None:
+            try:
+                conn = self._idle[kind].get_nowait()
+            except queue.Empty:
+                conn = get_connection(self.db_path, readonly=kind == "reader")
+            setattr(self._local, kind, conn)
+        return conn
+
+    def reader(self):
+        return self._checkout("reader")
+
+    def writer(self):
+        return self._checkout("writer")
+
+    def release(self):
+        """Devuelve al pool las conexiones de este hilo (cierra las que no entran)."""
+        for kind, idle in self._idle.items():
+            conn = getattr(self._local, kind, None)
+            if conn is None:
+                continue
+            setattr(self._local, kind, None)
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
 def init_db(conn):
     cur = conn.cursor()
     cur.executescript("""
@@ -59,14 +132,296 @@ def init_db(conn):
         created_at DATETIME DEFAULT CURRENT_TIMESTAMP
     );
 
+    CREATE TABLE IF NOT EXISTS replication_state (
+        replica_url TEXT PRIMARY KEY,
+        last_acked_event_id INTEGER NOT NULL DEFAULT 0,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS snapshots (
+        event_id INTEGER PRIMARY KEY,
+        filename TEXT NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+
     CREATE TABLE IF NOT EXISTS replica_meta (
         key TEXT PRIMARY KEY,
         value TEXT NOT NULL
     );
     """)
     conn.commit()
+    run_migrations(conn)
     ensure_admin_user(conn)
 
+
+# Migraciones versionadas sobre el esquema base de init_db().
+# Se aplican en orden al arrancar; nunca se edita una ya publicada, se agrega otra.
+MIGRATIONS = [
+    (1, "indices de timeline, perfil, comentarios y reacciones", """
+        CREATE INDEX IF NOT EXISTS idx_posts_created ON posts(created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_posts_user_created ON posts(user_id, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_comments_post_created ON comments(post_id, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_reactions_post_type ON reactions(post_id, reaction_type);
+    """),
+    (2, "contadores materializados por post (post_stats) mantenidos por triggers", """
+        CREATE TABLE IF NOT EXISTS post_stats (
+            post_id INTEGER PRIMARY KEY,
+            comments_count INTEGER NOT NULL DEFAULT 0,
+            reactions_count INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS post_reaction_stats (
+            post_id INTEGER NOT NULL,
+            reaction_type TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (post_id, reaction_type)
+        ) WITHOUT ROWID;
+
+        INSERT OR IGNORE INTO post_stats (post_id, comments_count, reactions_count)
+        SELECT p.id,
+               (SELECT COUNT(*) FROM comments c WHERE c.post_id = p.id),
+               (SELECT COUNT(*) FROM reactions r WHERE r.post_id = p.id)
+        FROM posts p;
+
+        INSERT OR IGNORE INTO post_reaction_stats (post_id, reaction_type, count)
+        SELECT r.post_id, r.reaction_type, COUNT(*)
+        FROM reactions r
+        JOIN posts p ON p.id = r.post_id
+        GROUP BY r.post_id, r.reaction_type;
+
+        CREATE TRIGGER IF NOT EXISTS trg_posts_stats_insert AFTER INSERT ON posts
+        BEGIN
+            INSERT OR IGNORE INTO post_stats (post_id) VALUES (NEW.id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_posts_stats_delete AFTER DELETE ON posts
+        BEGIN
+            DELETE FROM post_stats WHERE post_id = OLD.id;
+            DELETE FROM post_reaction_stats WHERE post_id = OLD.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_reactions_stats_insert AFTER INSERT ON reactions
+        WHEN EXISTS (SELECT 1 FROM post_stats WHERE post_id = NEW.post_id)
+        BEGIN
+            INSERT INTO post_reaction_stats (post_id, reaction_type, count)
+            VALUES (NEW.post_id, NEW.reaction_type, 1)
+            ON CONFLICT(post_id, reaction_type) DO UPDATE SET count = count + 1;
+            UPDATE post_stats SET reactions_count = reactions_count + 1 WHERE post_id = NEW.post_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_reactions_stats_update AFTER UPDATE OF reaction_type ON reactions
+        WHEN OLD.reaction_type IS NOT NEW.reaction_type
+             AND EXISTS (SELECT 1 FROM post_stats WHERE post_id = NEW.post_id)
+        BEGIN
+            UPDATE post_reaction_stats SET count = count - 1
+            WHERE post_id = OLD.post_id AND reaction_type = OLD.reaction_type;
+            DELETE FROM post_reaction_stats
+            WHERE post_id = OLD.post_id AND reaction_type = OLD.reaction_type AND count <= 0;
+            INSERT INTO post_reaction_stats (post_id, reaction_type, count)
+            VALUES (NEW.post_id, NEW.reaction_type, 1)
+            ON CONFLICT(post_id, reaction_type) DO UPDATE SET count = count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_reactions_stats_delete AFTER DELETE ON reactions
+        WHEN EXISTS (SELECT 1 FROM post_stats WHERE post_id = OLD.post_id)
+        BEGIN
+            UPDATE post_reaction_stats SET count = count - 1
+            WHERE post_id = OLD.post_id AND reaction_type = OLD.reaction_type;
+            DELETE FROM post_reaction_stats
+            WHERE post_id = OLD.post_id AND reaction_type = OLD.reaction_type AND count <= 0;
+            UPDATE post_stats SET reactions_count = reactions_count - 1 WHERE post_id = OLD.post_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_comments_stats_insert AFTER INSERT ON comments
+        BEGIN
+            UPDATE post_stats SET comments_count = comments_count + 1 WHERE post_id = NEW.post_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_comments_stats_delete AFTER DELETE ON comments
+        BEGIN
+            UPDATE post_stats SET comments_count = comments_count - 1 WHERE post_id = OLD.post_id;
+        END;
+    """),
+    (3, "variantes redimensionadas de imágenes (image_variants)", """
+        CREATE TABLE IF NOT EXISTS image_variants (
+            source TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            PRIMARY KEY (source, variant)
+        ) WITHOUT ROWID;
+    """),
+    (4, "archivos por contenido (media_files) con refcount mantenido por triggers", """
+        CREATE TABLE IF NOT EXISTS media_files (
+            name TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_media_files_unreferenced ON media_files(refcount, created_at);
+
+        CREATE TRIGGER IF NOT EXISTS trg_posts_media_insert AFTER INSERT ON posts
+        WHEN NEW.image_filename IS NOT NULL
+        BEGIN
+            UPDATE media_files SET refcount = refcount + 1 WHERE name = NEW.image_filename;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_posts_media_update AFTER UPDATE OF image_filename ON posts
+        WHEN NEW.image_filename IS NOT OLD.image_filename
+        BEGIN
+            UPDATE media_files SET refcount = refcount - 1 WHERE name = OLD.image_filename;
+            UPDATE media_files SET refcount = refcount + 1 WHERE name = NEW.image_filename;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_posts_media_delete AFTER DELETE ON posts
+        WHEN OLD.image_filename IS NOT NULL
+        BEGIN
+            UPDATE media_files SET refcount = refcount - 1 WHERE name = OLD.image_filename;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_media_update AFTER UPDATE OF profile_image ON users
+        WHEN NEW.profile_image IS NOT OLD.profile_image
+        BEGIN
+            UPDATE media_files SET refcount = refcount - 1 WHERE name = OLD.profile_image;
+            UPDATE media_files SET refcount = refcount + 1 WHERE name = NEW.profile_image;
+        END;
+    """),
+    (5, "sha256 de cada variante (verificación al copiarlas a las réplicas)", """
+        ALTER TABLE image_variants ADD COLUMN sha256 TEXT;
+    """),
+    (6, "índices del árbol de comentarios (raíces por post y respuestas por padre)", """
+        CREATE INDEX IF NOT EXISTS idx_comments_parent ON comments(parent_comment_id);
+        CREATE INDEX IF NOT EXISTS idx_comments_post_roots ON comments(post_id, parent_comment_id, created_at, id);
+    """),
+    (7, "búsqueda de texto completo (FTS5) sobre posts y comentarios, mantenida por triggers", """
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+            title, content,
+            content='posts', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS comments_fts USING fts5(
+            content,
+            content='comments', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+
+        -- rank ordena por bm25; una coincidencia en el título pesa más que en el cuerpo
+        INSERT INTO posts_fts (posts_fts, rank) VALUES ('rank', 'bm25(5.0, 1.0)');
+
+        INSERT INTO posts_fts (posts_fts) VALUES ('rebuild');
+        INSERT INTO comments_fts (comments_fts) VALUES ('rebuild');
+
+        CREATE TRIGGER IF NOT EXISTS trg_posts_fts_insert AFTER INSERT ON posts
+        BEGIN
+            INSERT INTO posts_fts (rowid, title, content) VALUES (NEW.id, NEW.title, NEW.content);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_posts_fts_update AFTER UPDATE OF title, content ON posts
+        BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, title, content) VALUES ('delete', OLD.id, OLD.title, OLD.content);
+            INSERT INTO posts_fts (rowid, title, content) VALUES (NEW.id, NEW.title, NEW.content);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_posts_fts_delete AFTER DELETE ON posts
+        BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, title, content) VALUES ('delete', OLD.id, OLD.title, OLD.content);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_comments_fts_insert AFTER INSERT ON comments
+        BEGIN
+            INSERT INTO comments_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_comments_fts_update AFTER UPDATE OF content ON comments
+        BEGIN
+            INSERT INTO comments_fts (comments_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            INSERT INTO comments_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_comments_fts_delete AFTER DELETE ON comments
+        BEGIN
+            INSERT INTO comments_fts (comments_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+        END;
+    """),
+    (8, "último evento que tocó cada post (post_changes), fuente de /api/reactions_summary", """
+        CREATE TABLE IF NOT EXISTS post_changes (
+            post_id INTEGER PRIMARY KEY,
+            event_id INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_post_changes_event ON post_changes(event_id);
+
+        -- lo anterior a este evento no está en post_changes (en el primario: su último evento;
+        -- en una réplica: el último aplicado). Los snapshots lo copian junto con la tabla.
+        INSERT OR REPLACE INTO replica_meta (key, value) VALUES ('post_changes_since', CAST(COALESCE(
+            (SELECT value FROM replica_meta WHERE key = 'last_event_id'),
+            (SELECT seq FROM sqlite_sequence WHERE name = 'events_log'),
+            0
+        ) AS TEXT));
+
+        -- en el primario la mantiene events_log; las réplicas (sin events_log) en apply_events()
+        CREATE TRIGGER IF NOT EXISTS trg_events_post_changes AFTER INSERT ON events_log
+        WHEN NEW.event_type IN ('CREATE_POST', 'REACT_POST', 'COMMENT_POST', 'DELETE_POST')
+        BEGIN
+            INSERT INTO post_changes (post_id, event_id)
+            VALUES (json_extract(NEW.payload, '$.post_id'), NEW.id)
+            ON CONFLICT(post_id) DO UPDATE SET event_id = excluded.event_id;
+        END;
+    """),
+]
+
+
+def _split_sql(script):
+    """Separa un script en sentencias (respeta los ; dentro de triggers)."""
+    statements, buf = [], ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            statements.append(buf.strip())
+            buf = ""
+    if buf.strip():
+        statements.append(buf.strip())
+    return statements
+
+
+def get_schema_version(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return cur.fetchone()[0]
+
+
+def run_migrations(conn):
+    """Aplica las migraciones pendientes en una transacción y registra su versión.
+
+    BEGIN IMMEDIATE evita que dos procesos que arrancan a la vez apliquen la
+    misma migración: el segundo espera y ya la encuentra registrada.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current = get_schema_version(conn)
+        for version, name, script in MIGRATIONS:
+            if version <= current:
+                continue
+            for statement in _split_sql(script):
+                conn.execute(statement)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (?, ?)",
+                (version, name)
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
 def ensure_admin_user(conn, username="admin", password="admin123"):
     cur = conn.cursor()
     cur.execute("SELECT id FROM users WHERE username = ?", (username,))
@@ -0,0 +1,129 @@
+"""Escrituras del primario con commit en grupo.
+
+Cada escritura es una función que recibe una Transaction, cambia las tablas
+base y registra su evento con tx.log(): fila y evento quedan en la misma
+transacción, así que no se puede perder uno sin el otro. Un solo hilo ejecuta
+las escrituras que llegan juntas (dentro de `window` segundos) en una única
+transacción, con un SAVEPOINT por escritura para que el fallo de una no
+arrastre a las demás.
+"""
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+from db_utils import get_connection
+
+BATCH_SIZE = metrics.histogram(
+    "leones_group_commit_batch_size", "Escrituras confirmadas en cada commit", (), metrics.COUNT_BUCKETS)
+COMMIT_SECONDS = metrics.histogram(
+    "leones_group_commit_seconds", "Duración de cada transacción del escritor de grupo")
+
+
+class Transaction:
+    """Lo que recibe cada escritura: el cursor y log() para sus eventos."""
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.events = []
+
+    def log(self, event_type, payload):
+        """Agrega el evento a events_log dentro de la misma transacción; devuelve su id."""
+        self.cur.execute(
+            "INSERT INTO events_log (event_type, payload) VALUES (?, ?)",
+            (event_type, json.dumps(payload))
+        )
+        event_id = self.cur.lastrowid
+        self.events.append((event_id, event_type, payload))
+        return event_id
+
+    @property
+    def last_event_id(self):
+        return self.events[-1][0] if self.events else None
+
+
+class GroupCommitter(threading.Thread):
+    """Único escritor del proceso; `on_commit()` se llama tras cada commit con eventos."""
+
+    def __init__(self, db_path, window=0.002, max_batch=128, on_commit=None):
+        super().__init__(name="group-committer", daemon=True)
+        self.window = window
+        self.max_batch = max_batch
+        self.on_commit = on_commit
+        self.conn = get_connection(db_path)
+        # BEGIN / COMMIT los maneja este hilo
+        self.conn.isolation_level = None
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+        self.commits = 0
+        self.writes = 0
+
+    def stop(self):
+        self._stopping.set()
+
+    def submit(self, fn):
+        """Encola fn(tx); el Future se resuelve con (resultado, último event_id) tras el commit."""
+        future = Future()
+        self._queue.put((fn, future))
+        return future
+
+    def write(self, fn):
+        return self.submit(fn).result()
+
+    # -------------------------------
+    # Bucle principal
+    # -------------------------------
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            # lo que llegue mientras tanto comparte el mismo commit
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        started = time.perf_counter()
+        cur = self.conn.cursor()
+        outcomes = []
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                tx = Transaction(cur)
+                cur.execute("SAVEPOINT unit")
+                try:
+                    result = fn(tx)
+                except Exception as e:
+                    cur.execute("ROLLBACK TO unit")
+                    cur.execute("RELEASE unit")
+                    outcomes.append((future, None, e))
+                    continue
+                cur.execute("RELEASE unit")
+                outcomes.append((future, (result, tx.last_event_id), None))
+            cur.execute("COMMIT")
+        except Exception as e:
+            if self.conn.in_transaction:
+                cur.execute("ROLLBACK")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.commits += 1
+        self.writes += len(batch)
+        BATCH_SIZE.observe(len(batch))
+        COMMIT_SECONDS.observe(time.perf_counter() - started)
+        if self.on_commit and any(result and result[1] for _, result, _ in outcomes):
+            self.on_commit()
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -0,0 +1,107 @@
+"""Procesamiento de imágenes fuera del request: miniaturas y versión de pantalla."""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from media import file_sha256
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # sin Pillow se siguen sirviendo los originales
+    Image = None
+
+try:
+    import pillow_heif  # en requirements.txt: los .heic de los teléfonos reciben variantes JPEG
+    pillow_heif.register_heif_opener()
+except ImportError:  # instalación sin pillow-heif: los .heic se sirven originales
+    pass
+
+# Lado mayor (px) de cada variante; nunca se agranda una imagen pequeña
+VARIANTS = {
+    "thumb": 320,
+    "display": 1080,
+}
+VARIANT_FOLDER = "variants"
+JPEG_QUALITY = 82
+
+
+class ImageProcessor:
+    """Pool de hilos que genera las variantes de cada imagen subida.
+
+    `on_done(source, variants, post_id, user_id)` se llama al terminar (con
+    variants = [{variant, filename, width, height, sha256}]) para que el servidor
+    las registre en image_variants junto con el evento que invalida lo que
+    mostraba la imagen original.
+    """
+
+    def __init__(self, db, static_root, on_done=None, workers=2):
+        self.db = db
+        self.static_root = static_root
+        self.on_done = on_done
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="images")
+        self._pending = set()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(static_root, VARIANT_FOLDER), exist_ok=True)
+        os.makedirs(os.path.join(static_root, "media"), exist_ok=True)
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    def submit(self, source, post_id=None, user_id=None):
+        """Encola `source` (ruta relativa a static/, p. ej. 'uploads/foto.jpg')."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if source in self._pending:
+                return None
+            self._pending.add(source)
+        return self.executor.submit(self._process, source, post_id, user_id)
+
+    def _process(self, source, post_id, user_id):
+        try:
+            self._process_once(source, post_id, user_id)
+        finally:
+            with self._lock:
+                self._pending.discard(source)
+
+    def _process_once(self, source, post_id, user_id):
+        cur = self.db.reader().cursor()
+        cur.execute("SELECT 1 FROM image_variants WHERE source = ? LIMIT 1", (source,))
+        if cur.fetchone():
+            # mismo contenido ya procesado (media/ es direccionado por contenido)
+            return
+        try:
+            variants = self._render_variants(source)
+        except Exception as e:
+            print(f"[images] no se pudo procesar {source}: {e}")
+            return
+        if self.on_done:
+            self.on_done(source, [
+                {"variant": name, "filename": filename, "width": w, "height": h, "sha256": sha}
+                for name, filename, w, h, sha in variants
+            ], post_id, user_id)
+
+    @staticmethod
+    def variant_filename(source, name):
+        """media/<sha>.jpg -> media/<sha>.thumb.jpg; las carpetas heredadas van a variants/."""
+        folder, base = source.split("/", 1)
+        stem = os.path.splitext(base)[0]
+        if folder == "media":
+            return f"media/{stem}.{name}.jpg"
+        return f"{VARIANT_FOLDER}/{folder}_{stem}.{name}.jpg"
+
+    def _render_variants(self, source):
+        out = []
+        with Image.open(os.path.join(self.static_root, source)) as im:
+            im = ImageOps.exif_transpose(im)
+            if im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            for name, size in VARIANTS.items():
+                variant = im.copy()
+                variant.thumbnail((size, size), Image.LANCZOS)
+                filename = self.variant_filename(source, name)
+                path = os.path.join(self.static_root, filename)
+                variant.save(path, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+                out.append((name, filename, variant.width, variant.height, file_sha256(path)))
+        return out
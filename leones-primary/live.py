@@ -0,0 +1,144 @@
+"""Actualizaciones en vivo (Server-Sent Events) a partir de events_log."""
+import json
+import queue
+import threading
+from collections import deque
+
+from db_utils import get_connection
+from queries import load_post_stats
+from snapshots import last_event_id
+
+# Eventos que se empujan a los navegadores
+LIVE_EVENT_TYPES = ("CREATE_POST", "REACT_POST", "COMMENT_POST", "DELETE_POST")
+
+
+class Subscriber:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.closed = False
+
+
+class EventBroadcaster(threading.Thread):
+    """Un solo hilo por proceso sigue events_log y reparte cada evento a todos
+    los suscriptores, así el costo en BD no depende de cuántas pestañas haya.
+
+    Seguir la tabla (en vez de recibir sólo los eventos de este proceso) hace
+    que funcione igual con varios workers de gunicorn.
+    """
+
+    def __init__(self, db_path, poll_interval=0.5, backlog=1000, subscriber_queue=256, max_subscribers=None):
+        super().__init__(name="event-broadcaster", daemon=True)
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self.subscriber_queue = subscriber_queue
+        self.max_subscribers = max_subscribers
+        self.conn = get_connection(db_path, readonly=True)
+        self.last_id = last_event_id(self.conn)
+        self._recent = deque(maxlen=backlog)
+        self._subscribers = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def notify(self):
+        """Despierta al hilo en cuanto este proceso escribe un evento."""
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def add_listener(self, fn):
+        """fn(event_id, event_type, payload) se llama con cada evento nuevo, de cualquier tipo."""
+        self._listeners.append(fn)
+
+    # -------------------------------
+    # Suscripciones
+    # -------------------------------
+    def subscribe(self, since=None):
+        """Nuevo suscriptor; con `since` (Last-Event-ID) recibe primero lo que se perdió.
+
+        Si `since` ya no está en el búfer reciente se le envía un evento
+        `reset` para que recargue los contadores completos. Devuelve None si
+        ya hay max_subscribers conectados.
+        """
+        sub = Subscriber(self.subscriber_queue)
+        with self._lock:
+            if self.max_subscribers is not None and len(self._subscribers) >= self.max_subscribers:
+                return None
+            if since is not None and since < self.last_id:
+                oldest = self._recent[0][0] if self._recent else self.last_id + 1
+                if since + 1 < oldest:
+                    sub.queue.put_nowait(self._format(self.last_id, "reset", {}))
+                else:
+                    for event_id, message in self._recent:
+                        if event_id > since:
+                            self._offer(sub, message)
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _offer(self, sub, message):
+        try:
+            sub.queue.put_nowait(message)
+        except queue.Full:
+            # cliente demasiado lento: se le corta y reconecta con Last-Event-ID
+            sub.closed = True
+
+    # -------------------------------
+    # Bucle principal
+    # -------------------------------
+    def run(self):
+        while not self._stopping.is_set():
+            self._wake.clear()
+            try:
+                self._poll()
+            except Exception as e:
+                print("[live] error:", e)
+            self._wake.wait(self.poll_interval)
+
+    def _poll(self):
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT id, event_type, payload FROM events_log WHERE id > ? ORDER BY id ASC LIMIT 500",
+            (self.last_id,)
+        )
+        rows = cur.fetchall()
+        for r in rows:
+            payload = json.loads(r["payload"])
+            for fn in self._listeners:
+                try:
+                    fn(r["id"], r["event_type"], payload)
+                except Exception as e:
+                    print("[live] error en listener:", e)
+            message = None
+            if r["event_type"] in LIVE_EVENT_TYPES:
+                message = self._format(r["id"], r["event_type"], self._event_data(cur, r["event_type"], payload))
+            with self._lock:
+                self.last_id = r["id"]
+                if message is None:
+                    continue
+                self._recent.append((r["id"], message))
+                for sub in list(self._subscribers):
+                    self._offer(sub, message)
+                    if sub.closed:
+                        self._subscribers.discard(sub)
+
+    def _event_data(self, cur, event_type, payload):
+        post_id = payload.get("post_id")
+        if event_type == "DELETE_POST":
+            return {"post_id": post_id}
+        # los contadores se leen una vez por evento, no una vez por cliente
+        return load_post_stats(cur, [post_id])[0]
+
+    @staticmethod
+    def _format(event_id, event_type, data):
+        return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
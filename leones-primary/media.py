@@ -0,0 +1,298 @@
+"""Almacenamiento direccionado por contenido de las imágenes subidas.
+
+Cada archivo se guarda como static/media/<sha256>.<ext>: dos subidas iguales
+comparten archivo y un nombre nunca cambia de contenido, así que puede
+servirse con caché inmutable. media_files lleva la cuenta de cuántos posts y
+usuarios apuntan a cada archivo (la mantienen triggers, ver migración 4).
+"""
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+MEDIA_FOLDER = os.path.join("static", "media")
+CHUNK_SIZE = 64 * 1024
+
+# Los nombres nunca cambian de contenido: caché de un año
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+# Tamaño de cada trozo al transferir archivos entre servidores
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+
+# Tiempo (segundos) que un archivo sin referencias se conserva antes de borrarse
+# (cubre la ventana entre guardar el archivo y confirmar el post que lo usa).
+# Se cuenta desde media_files.created_at y desde el mtime del archivo; las dos
+# se renuevan cada vez que alguien vuelve a subir o registrar el mismo contenido.
+UNREFERENCED_GRACE = 3600
+
+_MEDIA_NAME = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,5}$")
+# Original o variante (<sha256>.thumb.jpg): lo que puede vivir en static/media
+_STORED_NAME = re.compile(r"^[0-9a-f]{64}(\.[a-z]+)?\.[a-z0-9]{1,5}$")
+
+
+def is_media_name(filename):
+    """True si `filename` es un nombre <sha256>.<ext> (y no uno heredado)."""
+    return bool(filename) and bool(_MEDIA_NAME.match(filename))
+
+
+def media_source(folder, filename):
+    """Ruta relativa a static/ de una imagen: media/ o la carpeta heredada."""
+    if not filename:
+        return None
+    if is_media_name(filename):
+        return f"media/{filename}"
+    return f"{folder}/{filename}"
+
+
+def is_stored_name(name):
+    """True si `name` es un archivo válido de static/media (original o variante)."""
+    return bool(name) and bool(_STORED_NAME.match(name))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def send_media(name, media_root=MEDIA_FOLDER):
+    """Respuesta de /media/<name>: el nombre identifica el contenido, así que el ETag también."""
+    from flask import send_from_directory
+
+    resp = send_from_directory(os.path.abspath(media_root), name,
+                               etag=name.rsplit(".", 1)[0], max_age=MEDIA_MAX_AGE)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
+
+
+def _extension(original_name):
+    ext = os.path.splitext(original_name or "")[1].lower().lstrip(".")
+    return ext if re.fullmatch(r"[a-z0-9]{1,5}", ext) else "bin"
+
+
+def save_upload(file_storage, media_root=MEDIA_FOLDER):
+    """Copia el upload a disco calculando su sha256 en el mismo recorrido.
+
+    Devuelve (nombre, tamaño). Si el contenido ya existía se descarta la
+    copia temporal y se reutiliza el archivo, renovando su mtime para que
+    collect_unreferenced no lo borre antes de que se confirme el post.
+    """
+    os.makedirs(media_root, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=media_root, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = file_storage.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        name = f"{digest.hexdigest()}.{_extension(file_storage.filename)}"
+        final_path = os.path.join(media_root, name)
+        try:
+            os.utime(final_path)
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            # no existía (o el recolector se lo acaba de llevar): se publica la copia
+            os.replace(tmp_path, final_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return name, size
+
+
+def register(cur, name, size):
+    """Alta en media_files (en la misma transacción que el post/usuario que lo usa).
+
+    Si la fila ya existía se renueva created_at: un archivo reutilizado con
+    refcount 0 vuelve a tener el margen completo antes de que lo recojan.
+    """
+    cur.execute(
+        """
+        INSERT INTO media_files (name, size) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET created_at = CURRENT_TIMESTAMP
+        """,
+        (name, size)
+    )
+
+
+def _claim(path, cutoff):
+    """Aparta `path` si su mtime es anterior a `cutoff`; True si quedó apartado.
+
+    El rename es atómico frente a save_upload: o save_upload renovó el mtime
+    antes (y se devuelve el archivo a su sitio) o ya no lo encuentra y publica
+    su propia copia. Como el nombre es el contenido, devolverlo encima de una
+    copia nueva no cambia nada.
+    """
+    trash = os.path.join(os.path.dirname(path), f".trash-{os.path.basename(path)}")
+    try:
+        os.replace(path, trash)
+    except FileNotFoundError:
+        return True
+    if os.path.getmtime(trash) >= cutoff:
+        os.replace(trash, path)
+        return False
+    os.remove(trash)
+    return True
+
+
+def collect_unreferenced(conn, media_root=MEDIA_FOLDER, grace=UNREFERENCED_GRACE):
+    """Borra los archivos (y sus variantes) que ningún post ni usuario usa ya.
+
+    Candidatos: filas de media_files con refcount 0 y archivos de static/media
+    sin fila (subidas cuyo post falló después de save_upload). Cada uno se
+    vuelve a comprobar dentro de BEGIN IMMEDIATE antes de borrarlo, así que un
+    post que lo registra a la vez o lo confirma antes o lo encuentra intacto.
+    """
+    cutoff = time.time() - grace
+    age = f"-{int(grace)} seconds"
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT name FROM media_files WHERE refcount <= 0 AND created_at < datetime('now', ?)",
+        (age,)
+    )
+    candidates = [r["name"] for r in cur.fetchall()]
+    cur.execute("SELECT name FROM media_files")
+    known = {r["name"] for r in cur.fetchall()}
+    conn.commit()
+    if os.path.isdir(media_root):
+        with os.scandir(media_root) as entries:
+            candidates += [
+                e.name for e in entries
+                if is_media_name(e.name) and e.name not in known and e.stat().st_mtime < cutoff
+            ]
+
+    removed = []
+    for name in candidates:
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute(
+                "SELECT refcount > 0 OR created_at >= datetime('now', ?) AS live "
+                "FROM media_files WHERE name = ?",
+                (age, name)
+            )
+            row = cur.fetchone()
+            if (row is not None and row["live"]) or not _claim(os.path.join(media_root, name), cutoff):
+                conn.rollback()
+                continue
+            source = f"media/{name}"
+            cur.execute("SELECT filename FROM image_variants WHERE source = ?", (source,))
+            for r in cur.fetchall():
+                path = os.path.join(media_root, os.path.basename(r["filename"]))
+                if os.path.exists(path):
+                    os.remove(path)
+            cur.execute("DELETE FROM image_variants WHERE source = ?", (source,))
+            cur.execute("DELETE FROM media_files WHERE name = ?", (name,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        removed.append(name)
+    return removed
+
+
+# -------------------------------
+# Sincronización con réplicas
+# -------------------------------
+def referenced_media(event_type, payload):
+    """[(nombre, sha256)] de los archivos de static/media que usa un evento.
+
+    La réplica tiene que tenerlos antes de aplicar el evento.
+    """
+    refs = []
+    if event_type in ("CREATE_POST", "UPDATE_POST"):
+        name = payload.get("image_filename")
+    elif event_type == "UPDATE_USER":
+        name = payload.get("profile_image")
+    else:
+        name = None
+    if is_media_name(name):
+        refs.append((name, name.split(".", 1)[0]))
+    if event_type == "MEDIA_VARIANTS" and payload.get("source", "").startswith("media/"):
+        for v in payload.get("variants", []):
+            if v.get("sha256"):
+                refs.append((os.path.basename(v["filename"]), v["sha256"]))
+    return refs
+
+
+def stored_media(cur):
+    """[(nombre, sha256)] de todo lo que la BD referencia en static/media (tras un snapshot)."""
+    cur.execute("SELECT name FROM media_files")
+    refs = [(r["name"], r["name"].split(".", 1)[0]) for r in cur.fetchall()]
+    cur.execute(
+        "SELECT filename, sha256 FROM image_variants "
+        "WHERE filename LIKE 'media/%' AND sha256 IS NOT NULL"
+    )
+    refs += [(os.path.basename(r["filename"]), r["sha256"]) for r in cur.fetchall()]
+    return refs
+
+
+def partial_path(media_root, name):
+    return os.path.join(media_root, f".{name}.part")
+
+
+def transfer_offset(media_root, name):
+    """(bytes ya recibidos, completo) de una transferencia en curso."""
+    final_path = os.path.join(media_root, name)
+    if os.path.exists(final_path):
+        return os.path.getsize(final_path), True
+    part = partial_path(media_root, name)
+    return (os.path.getsize(part) if os.path.exists(part) else 0), False
+
+
+class ChecksumMismatch(Exception):
+    """El archivo recibido no coincide con el sha256 esperado."""
+
+
+def append_chunk(media_root, name, offset, data, total_size, sha256):
+    """Escribe un trozo en el .part y, al completarlo, lo verifica y publica.
+
+    Devuelve (offset actual, completo). Si `offset` no coincide con lo ya
+    recibido no escribe nada: el emisor reanuda desde el offset devuelto.
+    """
+    os.makedirs(media_root, exist_ok=True)
+    current, complete = transfer_offset(media_root, name)
+    if complete or offset != current:
+        return current, complete
+    part = partial_path(media_root, name)
+    with open(part, "ab") as f:
+        f.write(data)
+    current += len(data)
+    if current < total_size:
+        return current, False
+    if current > total_size or file_sha256(part) != sha256:
+        os.remove(part)
+        raise ChecksumMismatch(f"{name}: el contenido recibido no coincide con {sha256}")
+    os.replace(part, os.path.join(media_root, name))
+    return current, True
+
+
+def pull_media(session, base_url, name, sha256, media_root=MEDIA_FOLDER, timeout=30):
+    """Descarga `name` de {base_url}/media/ si falta, reanudando el .part con Range."""
+    offset, complete = transfer_offset(media_root, name)
+    if complete:
+        return False
+    os.makedirs(media_root, exist_ok=True)
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    resp = session.get(f"{base_url}/media/{name}", headers=headers, stream=True, timeout=timeout)
+    part = partial_path(media_root, name)
+    # 416: el .part ya tiene todo el archivo (se cortó antes de publicarlo)
+    if resp.status_code != 416:
+        resp.raise_for_status()
+        # sin 206 el servidor mandó el archivo entero: se empieza de cero
+        with open(part, "ab" if resp.status_code == 206 else "wb") as f:
+            for chunk in resp.iter_content(chunk_size=TRANSFER_CHUNK_SIZE):
+                f.write(chunk)
+    if file_sha256(part) != sha256:
+        os.remove(part)
+        raise ChecksumMismatch(f"{name}: el contenido descargado no coincide con {sha256}")
+    os.replace(part, os.path.join(media_root, name))
+    return True
@@ -0,0 +1,388 @@
+"""Métricas del proceso en formato de texto de Prometheus.
+
+- Conexiones instrumentadas: cada sentencia SQL se cuenta y se cronometra
+  dentro del request que la ejecuta (también las escrituras que corren en
+  el hilo del group commit, ver `bind()`).
+- Por ruta: histogramas de latencia, de consultas por request y de tiempo
+  en SQL; aviso de N+1 cuando una misma sentencia se repite en un request.
+- Log opcional de requests lentos (SLOW_REQUEST_MS) con las sentencias que
+  corrieron.
+
+Las métricas son por proceso: con varios workers de gunicorn cada uno
+expone las suyas.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Requests más lentos que esto (ms) se registran con sus sentencias; 0 lo desactiva
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 0))
+
+# Veces que una misma sentencia puede repetirse en un request antes de marcarlo como N+1
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("N_PLUS_ONE_THRESHOLD", 5))
+
+# Sentencias que se guardan por request para el log de lentos
+MAX_STATEMENTS_KEPT = 200
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# -------------------------------
+# Registro de métricas
+# -------------------------------
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._function = None
+
+    def _key(self, labels):
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def set_function(self, fn):
+        """Valor calculado al exponer: fn() devuelve un número o {(labels...): número}."""
+        self._function = fn
+        return self
+
+    def samples(self):
+        if self._function is None:
+            with self._lock:
+                return list(self._values.items())
+        value = self._function()
+        if isinstance(value, dict):
+            return list(value.items())
+        return [((), value)]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.samples():
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, (list(s[0]), s[1], s[2])) for key, s in self._values.items()]
+        for key, (counts, total, n) in items:
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', _number(bound))])} {count}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', '+Inf')])} {n}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {n}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._add(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram, name, help_text, labelnames, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+REQUEST_SECONDS = histogram(
+    "leones_request_duration_seconds", "Latencia de los requests por ruta", ("route", "method", "status"))
+REQUEST_QUERIES = histogram(
+    "leones_request_sql_queries", "Sentencias SQL por request", ("route",), COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = histogram(
+    "leones_request_sql_seconds", "Tiempo en SQL por request", ("route",))
+SQL_STATEMENTS = counter(
+    "leones_sql_statements_total", "Sentencias SQL ejecutadas dentro de requests", ("route",))
+N_PLUS_ONE = counter(
+    "leones_sql_n_plus_one_total", "Requests con una sentencia repetida al menos N_PLUS_ONE_THRESHOLD veces", ("route",))
+SLOW_REQUESTS = counter(
+    "leones_slow_requests_total", "Requests más lentos que SLOW_REQUEST_MS", ("route",))
+
+
+# -------------------------------
+# SQL por request
+# -------------------------------
+class RequestStats:
+    """Sentencias de un request: cuántas, cuánto tardaron y cuáles se repiten."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+        self.shapes = {}
+
+    def add(self, sql, seconds):
+        self.count += 1
+        self.seconds += seconds
+        shape = _shape(sql)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+        if len(self.statements) < MAX_STATEMENTS_KEPT:
+            self.statements.append([sql, seconds])
+
+    def add_time(self, seconds):
+        """Tiempo de fetch de la última sentencia."""
+        self.seconds += seconds
+        if self.statements:
+            self.statements[-1][1] += seconds
+
+    def repeated(self, threshold=N_PLUS_ONE_THRESHOLD):
+        return [(shape, n) for shape, n in self.shapes.items() if n >= threshold]
+
+
+_IN_LIST = re.compile(r"\(\s*\?(\s*,\s*\?)*\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def _shape(sql):
+    """Sentencia normalizada: mismos espacios y listas IN (?, ?, ...) de cualquier largo."""
+    return _IN_LIST.sub("(?...)", _SPACES.sub(" ", sql).strip())
+
+
+_local = threading.local()
+
+
+def current_stats():
+    return getattr(_local, "stats", None)
+
+
+def bind(fn):
+    """Envuelve fn(tx) para que lo que ejecute en otro hilo cuente en el request actual."""
+    stats = current_stats()
+    if stats is None:
+        return fn
+
+    def bound(*args, **kwargs):
+        previous = current_stats()
+        _local.stats = stats
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.stats = previous
+    return bound
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        stats = current_stats()
+        if stats is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            stats.add(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        stats = current_stats()
+        if stats is None:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            stats.add(sql, time.perf_counter() - started)
+
+    def executescript(self, sql_script):
+        stats = current_stats()
+        if stats is None:
+            return super().executescript(sql_script)
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            stats.add(sql_script, time.perf_counter() - started)
+
+    # SQLite produce las filas a medida que se leen: el fetch también es tiempo de la consulta
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+    def _timed_fetch(self, fetch, *args):
+        stats = current_stats()
+        if stats is None:
+            return fetch(*args)
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            stats.add_time(time.perf_counter() - started)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Conexión cuyos cursores (y sus atajos execute*) pasan por InstrumentedCursor."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute de sqlite3 no pasa por Cursor.execute: se redirige a mano
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+# -------------------------------
+# Integración con Flask
+# -------------------------------
+def init_app(app, name):
+    """Instrumenta los requests de `app` y agrega GET /metrics.
+
+    Tiene que llamarse antes de abrir conexiones: sólo las que se abren
+    después usan InstrumentedConnection.
+    """
+    from flask import Response, g, request
+
+    import db_utils
+
+    db_utils.set_connection_factory(InstrumentedConnection)
+
+    def route_label():
+        rule = request.url_rule
+        return rule.rule if rule is not None else "<sin ruta>"
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        _local.stats = RequestStats()
+
+    @app.after_request
+    def record_request_metrics(resp):
+        started = g.pop("metrics_started", None)
+        stats = current_stats()
+        _local.stats = None
+        if started is None or stats is None:
+            return resp
+        elapsed = time.perf_counter() - started
+        route = route_label()
+        REQUEST_SECONDS.observe(elapsed, route=route, method=request.method, status=f"{resp.status_code // 100}xx")
+        REQUEST_QUERIES.observe(stats.count, route=route)
+        REQUEST_SQL_SECONDS.observe(stats.seconds, route=route)
+        SQL_STATEMENTS.inc(stats.count, route=route)
+        resp.headers["X-SQL-Queries"] = str(stats.count)
+
+        repeated = stats.repeated()
+        if repeated:
+            N_PLUS_ONE.inc(route=route)
+            for shape, n in repeated:
+                print(f"[{name}] posible N+1 en {request.method} {route}: {n}x {shape[:200]}")
+        if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+            SLOW_REQUESTS.inc(route=route)
+            _log_slow(name, route, elapsed, stats)
+        return resp
+
+    @app.teardown_request
+    def clear_request_metrics(_error=None):
+        _local.stats = None
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+def _log_slow(name, route, elapsed, stats):
+    from flask import request
+
+    lines = [
+        f"[{name}] request lento: {request.method} {request.full_path.rstrip('?')} ({route}) "
+        f"{elapsed * 1000:.1f} ms, {stats.count} sentencias SQL en {stats.seconds * 1000:.1f} ms"
+    ]
+    for sql, seconds in stats.statements:
+        lines.append(f"    {seconds * 1000:8.2f} ms  {_SPACES.sub(' ', sql).strip()[:300]}")
+    if stats.count > len(stats.statements):
+        lines.append(f"    ... y {stats.count - len(stats.statements)} sentencias más")
+    print("\n".join(lines))
@@ -0,0 +1,106 @@
+"""Caché de HTML renderizado para visitantes anónimos (páginas y tarjetas de post)."""
+import threading
+from collections import OrderedDict
+
+
+class PageEntry:
+    def __init__(self, html, post_ids, profile_user_id, built_at):
+        self.html = html
+        self.post_ids = frozenset(post_ids)
+        self.profile_user_id = profile_user_id
+        self.built_at = built_at
+
+
+class PageCache:
+    """LRU de páginas completas y de fragmentos por post.
+
+    Cada entrada recuerda el id de events_log con el que se construyó y los
+    posts que muestra; on_event() descarta exactamente las entradas afectadas
+    por el post (o usuario) de cada evento.
+    """
+
+    def __init__(self, maxsize=256, fragment_maxsize=2048):
+        self.maxsize = maxsize
+        self.fragment_maxsize = fragment_maxsize
+        self._pages = OrderedDict()
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+        # último evento procesado por on_event
+        self.last_event_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    # -------------------------------
+    # Páginas completas
+    # -------------------------------
+    def get_page(self, key):
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put_page(self, key, html, post_ids, built_at, profile_user_id=None):
+        """Guarda la página salvo que ya se haya procesado un evento posterior a
+        `built_at` (podría haberla invalidado antes de existir)."""
+        with self._lock:
+            if self.last_event_id > built_at:
+                return
+            self._pages[key] = PageEntry(html, post_ids, profile_user_id, built_at)
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.maxsize:
+                self._pages.popitem(last=False)
+
+    # -------------------------------
+    # Fragmentos (tarjeta de un post)
+    # -------------------------------
+    def get_fragment(self, post_id):
+        with self._lock:
+            html = self._fragments.get(post_id)
+            if html is not None:
+                self._fragments.move_to_end(post_id)
+            return html
+
+    def put_fragment(self, post_id, html, built_at):
+        with self._lock:
+            if self.last_event_id > built_at:
+                return
+            self._fragments[post_id] = html
+            self._fragments.move_to_end(post_id)
+            while len(self._fragments) > self.fragment_maxsize:
+                self._fragments.popitem(last=False)
+
+    # -------------------------------
+    # Invalidación
+    # -------------------------------
+    def on_event(self, event_id, event_type, payload):
+        """Listener de events_log."""
+        post_id = payload.get("post_id")
+        user_id = payload.get("user_id")
+        with self._lock:
+            self.last_event_id = max(self.last_event_id, event_id)
+            if post_id is not None:
+                self._fragments.pop(post_id, None)
+
+            stale = []
+            for key, entry in self._pages.items():
+                if post_id is not None and post_id in entry.post_ids:
+                    stale.append(key)
+                elif event_type == "CREATE_POST" and self._is_first_page(key, entry, user_id):
+                    # un post nuevo sólo aparece en la primera página (las
+                    # siguientes van por cursor y no se desplazan)
+                    stale.append(key)
+                elif event_type in ("UPDATE_USER", "MEDIA_VARIANTS") and entry.profile_user_id == user_id:
+                    stale.append(key)
+            for key in stale:
+                del self._pages[key]
+
+    @staticmethod
+    def _is_first_page(key, entry, user_id):
+        before = key[-1]
+        if before:
+            return False
+        return key[0] == "index" or entry.profile_user_id == user_id
@@ -0,0 +1,122 @@
+"""Hash y verificación de contraseñas fuera de los hilos de request.
+
+scrypt/pbkdf2 son caros a propósito: corriendo en el hilo del request, una
+ráfaga de logins frena todas las demás rutas. Acá corren en un pool de
+procesos acotado; si ya hay MAX_PENDING operaciones en curso se rechaza al
+instante (HasherBusy -> 503) en lugar de encolar sin límite.
+
+El método se configura con PASSWORD_HASH_METHOD (formato de Werkzeug, p.
+ej. "scrypt:16384:8:1" o "pbkdf2:sha256:600000"); los hashes con otro
+método se regeneran en el siguiente login correcto (ver needs_rehash).
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import metrics
+
+HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+# Operaciones en curso (ejecutándose o en cola) antes de responder 503
+MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", HASH_WORKERS * 4))
+# Segundos de espera por un resultado antes de darlo por saturado
+HASH_TIMEOUT = 10
+
+HASH_SECONDS = metrics.histogram(
+    "leones_password_hash_seconds", "Duración de hash/verificación (incluida la espera en cola)", ("op",))
+REJECTED = metrics.counter(
+    "leones_password_hash_rejected_total", "Operaciones rechazadas por pool saturado", ("op",))
+REHASHED = metrics.counter(
+    "leones_password_rehash_total", "Hashes regenerados en el login por cambio de método")
+
+
+class HasherBusy(Exception):
+    """El pool de hash está saturado: el cliente debe reintentar más tarde."""
+
+
+def hash_method(pwhash):
+    """Método (con parámetros) de un hash de Werkzeug: 'scrypt:32768:8:1$sal$hash' -> 'scrypt:32768:8:1'."""
+    if not pwhash or "$" not in pwhash:
+        return None
+    return pwhash.split("$", 1)[0]
+
+
+def _context():
+    # fork: los hijos no reimportan el módulo principal (con spawn lo harían
+    # y arrancarían otro servidor); por eso el pool se crea antes que los hilos
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
+
+
+class PasswordHasher:
+    def __init__(self, method=HASH_METHOD, workers=HASH_WORKERS, max_pending=MAX_PENDING):
+        # Werkzeug completa los parámetros por defecto ("scrypt" -> "scrypt:32768:8:1")
+        self.method = hash_method(generate_password_hash("", method))
+        self.workers = workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._restart_lock = threading.Lock()
+        self.pending = 0
+        self._pool = None
+        metrics.gauge(
+            "leones_password_hash_pending", "Operaciones de hash en curso o en cola"
+        ).set_function(lambda: self.pending)
+        self._start_pool()
+        # cerrar el pool antes del teardown del intérprete (si no, ruido en stderr al salir)
+        atexit.register(self.shutdown)
+
+    def _start_pool(self):
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_context())
+        # con fork los procesos nacen en el primer submit: que sea ahora, antes de los hilos
+        self._pool.submit(hash_method, "").result()
+
+    def _restart_pool(self, broken):
+        with self._restart_lock:
+            if self._pool is broken:
+                print("[passwords] pool de hash roto, reiniciando")
+                self._start_pool()
+
+    def _run(self, op, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                REJECTED.inc(op=op)
+                raise HasherBusy(f"{self.pending} operaciones de hash en curso")
+            self.pending += 1
+        started = time.perf_counter()
+        try:
+            pool = self._pool
+            try:
+                return pool.submit(fn, *args).result(timeout=HASH_TIMEOUT)
+            except BrokenProcessPool:
+                # un proceso del pool murió: se rehace y se reintenta una vez
+                self._restart_pool(pool)
+                return self._pool.submit(fn, *args).result(timeout=HASH_TIMEOUT)
+        except FutureTimeout:
+            REJECTED.inc(op=op)
+            raise HasherBusy(f"sin respuesta del pool en {HASH_TIMEOUT} s")
+        finally:
+            with self._lock:
+                self.pending -= 1
+            HASH_SECONDS.observe(time.perf_counter() - started, op=op)
+
+    def hash(self, password):
+        return self._run("hash", generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run("verify", check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True si el hash se generó con otro método o parámetros que los configurados."""
+        return hash_method(pwhash) != self.method
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
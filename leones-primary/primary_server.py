@@ -1,30 +1,72 @@
-from flask import Flask, request, redirect, render_template, session, url_for, jsonify
+from flask import (
+    Flask, Response, g, has_request_context, request, redirect, render_template, session, url_for, jsonify,
+    send_from_directory,
+)
 import json
-import requests
 import os
+import queue
+import sqlite3
 from datetime import datetime, timedelta
 
-from db_utils import get_connection, init_db
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import metrics
+from db_utils import ConnectionPool, init_db
+from queries import (
+    load_timeline, load_profile_posts, load_post_stats, attach_post_details, load_comments_count_by_post,
+    attach_image_variants, load_image_variants, check_query_plans,
+)
+from replication import ReplicationWorker, has_replication_secret
+from snapshots import SNAPSHOT_DIR, SnapshotWorker, last_event_id, latest_snapshot
+from live import EventBroadcaster
+from user_cache import UserCache
+from page_cache import PageCache
+from read_api import create_read_api
+from images import ImageProcessor
+from group_commit import GroupCommitter
+from media import MEDIA_FOLDER, media_source, register as register_media, save_upload, send_media
+from markupsafe import Markup
+from passwords import REHASHED, HasherBusy, PasswordHasher
 
 app = Flask(__name__)
+
+# Antes de abrir la primera conexión: así todas quedan instrumentadas
+metrics.init_app(app, "primary")
+
+# Pool de procesos para scrypt: se crea (y forkea) antes de abrir la base y arrancar hilos
+hasher = PasswordHasher()
 app.secret_key = "cambia-esta-clave"
 
 DB_PATH = os.path.join("db", "primary.db")
 
-# Carpeta para subir imágenes de posts
+# Carpetas heredadas de imágenes de posts y avatares (sólo lectura: lo nuevo va a static/media)
 UPLOAD_FOLDER = os.path.join("static", "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
-# Carpeta para avatares
 AVATAR_FOLDER = os.path.join("static", "avatars")
 os.makedirs(AVATAR_FOLDER, exist_ok=True)
 
-# URLs de las réplicas
+# Posts por página en timeline, perfil y /api/feed
+PAGE_SIZE = 20
+
+# Tamaño de página de /sync (eventos por respuesta)
+SYNC_DEFAULT_LIMIT = 1000
+SYNC_MAX_LIMIT = 5000
+
+# Segundos entre latidos de las conexiones SSE inactivas
+SSE_HEARTBEAT = 15
+
+# Conexiones SSE simultáneas por proceso: cada una ocupa un hilo de gunicorn
+# mientras dure. Las pestañas que no entran sondean /api/reactions_summary.
+SSE_MAX_SUBSCRIBERS = int(os.environ.get("SSE_MAX_SUBSCRIBERS", 16))
+
+# Cada cuánto (segundos) se toma un snapshot y se compacta events_log
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", 3600))
+
+# URLs de las réplicas (separadas por coma en REPLICAS)
 REPLICAS = [
-    "http://localhost:5001",
-    "http://localhost:5002",
+    url.strip().rstrip("/")
+    for url in os.environ.get("REPLICAS", "http://localhost:5001,http://localhost:5002").split(",")
+    if url.strip()
 ]
 
 # IPs que pueden usar funciones de admin (además de ser admin en la BD)
@@ -33,17 +75,130 @@ ADMIN_IPS = {
     "127.0.0.1"     # localhost
 }
 
-conn = get_connection(DB_PATH)
-init_db(conn)
+# Desde dónde llegan los requests del router (separadas por coma en TRUSTED_PROXIES).
+# Sólo a ellos se les cree X-Forwarded-For; al resto se lo ignora.
+TRUSTED_PROXIES = {
+    ip.strip()
+    for ip in os.environ.get("TRUSTED_PROXIES", "127.0.0.1").split(",")
+    if ip.strip()
+}
+
+
+def trust_router(wsgi_app):
+    """remote_addr = IP del cliente que informa el router (y sólo si el request viene de él)."""
+    proxied = ProxyFix(wsgi_app, x_for=1)
+
+    def dispatch(environ, start_response):
+        if environ.get("REMOTE_ADDR") in TRUSTED_PROXIES:
+            return proxied(environ, start_response)
+        return wsgi_app(environ, start_response)
+    return dispatch
+
+
+app.wsgi_app = trust_router(app.wsgi_app)
+
+# Pool por hilo: lecturas y escrituras van por conexiones distintas (WAL)
+db = ConnectionPool(DB_PATH)
+init_db(db.writer())
+
+
+def backfill_user_events(conn):
+    """CREATE_USER/UPDATE_USER para los usuarios anteriores a esos eventos (una sola vez).
+
+    Las réplicas sólo conocen a los usuarios por eventos: sin esto los posts
+    de usuarios viejos no salen en su timeline (el JOIN con users los descarta)
+    y sus perfiles dan 404. En las réplicas es idempotente (INSERT OR IGNORE).
+    La marca queda en replica_meta; BEGIN IMMEDIATE evita que dos workers lo repitan.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM replica_meta WHERE key = 'users_backfilled'").fetchone() is None:
+            users = conn.execute(
+                "SELECT id, username, role, profile_image, restricted_until, created_at FROM users ORDER BY id"
+            ).fetchall()
+            for u in users:
+                events = [("CREATE_USER", {
+                    "user_id": u["id"], "username": u["username"], "role": u["role"],
+                    "created_at": u["created_at"],
+                })]
+                if u["profile_image"] or u["restricted_until"]:
+                    events.append(("UPDATE_USER", {
+                        "user_id": u["id"], "profile_image": u["profile_image"],
+                        "restricted_until": u["restricted_until"], "role": u["role"],
+                    }))
+                conn.executemany(
+                    "INSERT INTO events_log (event_type, payload) VALUES (?, ?)",
+                    [(event_type, json.dumps(payload)) for event_type, payload in events]
+                )
+            conn.execute(
+                "INSERT INTO replica_meta (key, value) VALUES ('users_backfilled', ?)", (str(len(users)),)
+            )
+            print(f"[primary] eventos de alta registrados para {len(users)} usuarios existentes")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+backfill_user_events(db.writer())
+
+# Avisar si alguna consulta caliente dejó de usar sus índices
+for name, detail in check_query_plans(db.reader()):
+    print(f"[primary] plan de consulta degradado en {name}: {detail}")
+db.release()
+
+# Worker de replicación: lee events_log en segundo plano y lo envía a REPLICAS
+replicator = ReplicationWorker(DB_PATH, REPLICAS, media_root=MEDIA_FOLDER)
+replicator.start()
+
+# Snapshots periódicos + compactación del log ya confirmado por todas las réplicas
+snapshotter = SnapshotWorker(DB_PATH, REPLICAS, SNAPSHOT_INTERVAL, media_root=MEDIA_FOLDER)
+snapshotter.start()
+
+# Un hilo por proceso sigue events_log y alimenta todas las conexiones SSE
+broadcaster = EventBroadcaster(DB_PATH, max_subscribers=SSE_MAX_SUBSCRIBERS)
+
+# Caché de usuarios por id; los eventos de usuario (de cualquier worker) la invalidan
+user_cache = UserCache()
+broadcaster.add_listener(user_cache.on_event)
+
+# HTML de timeline/perfil para visitantes anónimos, invalidado por post en cada evento
+page_cache = PageCache()
+broadcaster.add_listener(page_cache.on_event)
+broadcaster.start()
+
+# Único escritor del proceso: fila + evento en una transacción y commits en grupo
+committer = GroupCommitter(DB_PATH, on_commit=lambda: (replicator.notify(), broadcaster.notify()))
+committer.start()
+
+# API JSON de lectura (la misma que sirven las réplicas)
+app.register_blueprint(create_read_api(db, lambda: last_event_id(db.reader())))
+
+metrics.gauge("leones_sse_subscribers", "Conexiones SSE abiertas en este proceso").set_function(
+    broadcaster.subscriber_count
+)
+metrics.gauge("leones_last_event_id", "Último evento de events_log").set_function(
+    lambda: last_event_id(db.reader())
+)
 
 
 def current_user():
+    """Usuario de la sesión: memorizado por request y cacheado entre requests."""
     if "user_id" not in session:
         return None
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id = ?", (session["user_id"],))
-    row = cur.fetchone()
-    return dict(row) if row else None
+    if "current_user" in g:
+        return g.current_user
+    user_id = session["user_id"]
+    user = user_cache.get(user_id)
+    if user is None:
+        cur = db.reader().cursor()
+        cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+        row = cur.fetchone()
+        user = dict(row) if row else None
+        if user:
+            user_cache.put(user_id, user)
+    g.current_user = user
+    return user
 
 
 def is_admin_allowed():
@@ -68,69 +223,168 @@ def is_restricted(user):
     return datetime.utcnow() < until
 
 
-def log_event(event_type, payload_dict):
-    cur = conn.cursor()
-    payload_json = json.dumps(payload_dict)
-    cur.execute(
-        "INSERT INTO events_log (event_type, payload) VALUES (?, ?)",
-        (event_type, payload_json)
-    )
-    conn.commit()
-    event_id = cur.lastrowid
-    return event_id, payload_json
-
-
-def replicate_event(event_id, event_type, payload_json):
-    body = {
-        "event_id": event_id,
-        "event_type": event_type,
-        "payload": json.loads(payload_json),
-    }
-    for replica in REPLICAS:
-        try:
-            url = f"{replica}/replicate"
-            requests.post(url, json=body, timeout=1)
-        except Exception:
-            pass
+def write(fn):
+    """Ejecuta fn(tx) en el escritor de grupo y devuelve su resultado.
 
+    fn corre en el hilo del escritor: sólo debe usar tx.cur y tx.log() y los
+    valores que ya capturó (nada de request ni de db.writer()).
+    """
+    result, event_id = committer.write(metrics.bind(fn))
+    if event_id is not None and has_request_context():
+        g.written_event_id = event_id
+    return result
 
-@app.route("/")
-def index():
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT p.id, p.title, p.content, p.image_filename, p.created_at, u.username
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        ORDER BY p.created_at DESC
-    """)
-    posts = [dict(row) for row in cur.fetchall()]
-
-    for p in posts:
-        cur.execute(
-            "SELECT reaction_type, COUNT(*) AS c FROM reactions WHERE post_id = ? GROUP BY reaction_type",
-            (p["id"],)
-        )
-        reactions = {r["reaction_type"]: r["c"] for r in cur.fetchall()}
-        p["reactions_by_type"] = reactions
 
-        cur.execute(
-            "SELECT c.id, c.content, c.created_at, c.parent_comment_id, u.username "
-            "FROM comments c "
-            "JOIN users u ON c.user_id = u.id "
-            "WHERE c.post_id = ? "
-            "ORDER BY c.created_at ASC",
-            (p["id"],)
+@app.after_request
+def add_event_id_header(resp):
+    """Tras una escritura, X-Event-Id dice qué evento debe ver una lectura posterior."""
+    if "written_event_id" in g:
+        resp.headers["X-Event-Id"] = str(g.written_event_id)
+    return resp
+
+
+@app.after_request
+def release_connections(resp):
+    """Devuelve las conexiones del hilo al pool cuando termina la respuesta (incluido un stream)."""
+    resp.call_on_close(db.release)
+    return resp
+
+
+def log_user_update(tx, user_id):
+    """Registra (dentro de tx) el estado actual de los campos editables de un usuario."""
+    tx.cur.execute("SELECT profile_image, restricted_until, role FROM users WHERE id = ?", (user_id,))
+    row = tx.cur.fetchone()
+    tx.log("UPDATE_USER", {
+        "user_id": user_id,
+        "profile_image": row["profile_image"],
+        "restricted_until": row["restricted_until"],
+        "role": row["role"],
+    })
+
+
+def record_media_variants(source, variants, post_id, user_id):
+    """Las variantes de `source` ya están en disco: se registran y se avisa a cachés y réplicas."""
+    def tx_fn(tx):
+        tx.cur.executemany(
+            """
+            INSERT OR REPLACE INTO image_variants (source, variant, filename, width, height, sha256)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [(source, v["variant"], v["filename"], v["width"], v["height"], v["sha256"]) for v in variants]
         )
-        p["comments"] = [dict(row) for row in cur.fetchall()]
+        tx.log("MEDIA_VARIANTS", {
+            "source": source,
+            "post_id": post_id,
+            "user_id": user_id,
+            "variants": variants,
+        })
+    write(tx_fn)
+
+
+# Miniaturas y versión de pantalla de las imágenes subidas, fuera del request
+images = ImageProcessor(db, "static", on_done=record_media_variants)
+
 
+def _file_url(path):
+    """media/... se sirve por /media (caché inmutable); lo heredado, por /static."""
+    if path.startswith("media/"):
+        return url_for("media_file", name=path[len("media/"):])
+    return url_for("static", filename=path)
+
+
+@app.template_global()
+def image_url(folder, filename, variants=None, variant="display"):
+    """URL de la variante pedida o, si aún no existe, de la imagen original."""
+    chosen = (variants or {}).get(variant)
+    return _file_url(chosen["filename"] if chosen else media_source(folder, filename))
+
+
+@app.template_global()
+def image_srcset(variants):
+    return ", ".join(
+        f"{_file_url(v['filename'])} {v['width']}w"
+        for v in sorted((variants or {}).values(), key=lambda v: v["width"])
+    )
+
+
+def render_cards(cur, posts, user, admin_allowed, built_at):
+    """Tarjetas de post ya renderizadas.
+
+    Para visitantes anónimos se reutilizan los fragmentos cacheados y sólo se
+    cargan reacciones/comentarios de los posts que no estaban en caché.
+    """
+    if user:
+        attach_post_details(cur, posts)
+        return [
+            Markup(render_template("_post_card.html", post=p, user=user, admin_allowed=admin_allowed))
+            for p in posts
+        ]
+
+    cards = {p["id"]: page_cache.get_fragment(p["id"]) for p in posts}
+    missing = [p for p in posts if cards[p["id"]] is None]
+    attach_post_details(cur, missing)
+    for p in missing:
+        html = render_template("_post_card.html", post=p, user=None, admin_allowed=False)
+        page_cache.put_fragment(p["id"], html, built_at)
+        cards[p["id"]] = html
+    return [Markup(cards[p["id"]]) for p in posts]
+
+
+@app.route("/")
+def index():
+    before = request.args.get("before")
     user = current_user()
-    return render_template(
+    cache_key = ("index", before)
+    if user is None:
+        cached = page_cache.get_page(cache_key)
+        if cached:
+            return cached.html
+
+    cur = db.reader().cursor()
+    # se lee antes que los posts: el delta posterior nunca se salta un cambio
+    events_seen = last_event_id(db.reader())
+    posts, next_cursor = load_timeline(cur, before, PAGE_SIZE, with_details=False)
+
+    admin_allowed = is_admin_allowed()
+    html = render_template(
         "index.html",
-        posts=posts,
+        cards=render_cards(cur, posts, user, admin_allowed, events_seen),
+        next_cursor=next_cursor,
+        last_event_id=events_seen,
         user=user,
-        admin_allowed=is_admin_allowed(),
+        admin_allowed=admin_allowed,
         restricted=is_restricted(user)
     )
+    if user is None:
+        page_cache.put_page(cache_key, html, [p["id"] for p in posts], events_seen)
+    return html
+
+
+@app.route("/api/feed")
+def api_feed():
+    """Siguiente página del timeline para el scroll infinito de index.html."""
+    cur = db.reader().cursor()
+    events_seen = last_event_id(db.reader())
+    posts, next_cursor = load_timeline(cur, request.args.get("before"), PAGE_SIZE, with_details=False)
+
+    user = current_user()
+    cards = render_cards(cur, posts, user, is_admin_allowed(), events_seen)
+    return jsonify({
+        "post_ids": [p["id"] for p in posts],
+        "html": "".join(cards),
+        "next_cursor": next_cursor,
+    })
+
+
+@app.route("/search")
+def search():
+    """Página de búsqueda; los resultados los pide el navegador a /api/search (réplicas)."""
+    return render_template(
+        "search.html",
+        query=request.args.get("q", "").strip(),
+        user=current_user(),
+        admin_allowed=is_admin_allowed()
+    )
 
 
 @app.route("/register", methods=["GET", "POST"])
@@ -140,16 +394,25 @@ def register():
         password = request.form["password"].strip()
         if not username or not password:
             return render_template("register.html", error="Completa todos los campos.")
-        cur = conn.cursor()
-        try:
-            cur.execute(
-                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-                (username, generate_password_hash(password))
+        password_hash = hasher.hash(password)
+
+        def tx_fn(tx):
+            tx.cur.execute(
+                "INSERT INTO users (username, password_hash) VALUES (?, ?) RETURNING id, created_at",
+                (username, password_hash)
             )
-            conn.commit()
-            return redirect(url_for("login"))
-        except Exception:
+            user_id, created_at = tx.cur.fetchone()
+            tx.log("CREATE_USER", {
+                "user_id": user_id,
+                "username": username,
+                "role": "user",
+                "created_at": created_at,
+            })
+        try:
+            write(tx_fn)
+        except sqlite3.IntegrityError:
             return render_template("register.html", error="Usuario ya existe.")
+        return redirect(url_for("login"))
     return render_template("register.html")
 
 
@@ -158,16 +421,43 @@ def login():
     if request.method == "POST":
         username = request.form["username"].strip()
         password = request.form["password"].strip()
-        cur = conn.cursor()
+        cur = db.reader().cursor()
         cur.execute("SELECT * FROM users WHERE username = ?", (username,))
         row = cur.fetchone()
-        if row and check_password_hash(row["password_hash"], password):
+        if row and hasher.verify(row["password_hash"], password):
+            if hasher.needs_rehash(row["password_hash"]):
+                rehash_password(row["id"], row["password_hash"], password)
             session["user_id"] = row["id"]
             return redirect(url_for("index"))
         return render_template("login.html", error="Datos incorrectos.")
     return render_template("login.html")
 
 
+def rehash_password(user_id, old_hash, password):
+    """Regenera el hash con el método configurado (tras un login correcto).
+
+    Los hashes no viajan a las réplicas (no autentican), así que no hay evento.
+    Si el pool está saturado se deja para el próximo login.
+    """
+    try:
+        new_hash = hasher.hash(password)
+    except HasherBusy:
+        return
+    write(lambda tx: tx.cur.execute(
+        "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+        (new_hash, user_id, old_hash)
+    ))
+    REHASHED.inc()
+
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(e):
+    """Pool de hash saturado: 503 inmediato en lugar de dejar el request esperando."""
+    template = "register.html" if request.endpoint == "register" else "login.html"
+    html = render_template(template, error="Hay demasiados inicios de sesión en curso. Intenta de nuevo en unos segundos.")
+    return html, 503, {"Retry-After": "1"}
+
+
 @app.route("/logout")
 def logout():
     session.clear()
@@ -191,27 +481,32 @@ def create_post():
     image_file = request.files.get("image")
     image_filename = None
     if image_file and image_file.filename:
-        filename = secure_filename(image_file.filename)
-        image_path = os.path.join(UPLOAD_FOLDER, filename)
-        image_file.save(image_path)
-        image_filename = filename
-
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO posts (user_id, title, content, image_filename) VALUES (?, ?, ?, ?)",
-        (user["id"], title, content, image_filename)
-    )
-    conn.commit()
-    post_id = cur.lastrowid
-
-    event_id, payload_json = log_event("CREATE_POST", {
-        "post_id": post_id,
-        "user_id": user["id"],
-        "title": title,
-        "content": content,
-        "image_filename": image_filename,
-    })
-    replicate_event(event_id, "CREATE_POST", payload_json)
+        image_filename, image_size = save_upload(image_file)
+
+    user_id = user["id"]
+
+    def tx_fn(tx):
+        if image_filename:
+            register_media(tx.cur, image_filename, image_size)
+        # created_at viaja en el evento: los cursores (created_at, id) valen igual en las réplicas
+        tx.cur.execute(
+            "INSERT INTO posts (user_id, title, content, image_filename) VALUES (?, ?, ?, ?) "
+            "RETURNING id, created_at",
+            (user_id, title, content, image_filename)
+        )
+        post_id, created_at = tx.cur.fetchone()
+        tx.log("CREATE_POST", {
+            "post_id": post_id,
+            "user_id": user_id,
+            "title": title,
+            "content": content,
+            "image_filename": image_filename,
+            "created_at": created_at,
+        })
+        return post_id
+    post_id = write(tx_fn)
+    if image_filename:
+        images.submit(media_source("uploads", image_filename), post_id=post_id)
 
     return redirect(url_for("profile", username=user["username"]))
 
@@ -231,38 +526,27 @@ def react_post(post_id):
 
     reaction_type = request.form.get("reaction_type", "like").strip() or "like"
 
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO reactions (user_id, post_id, reaction_type)
-        VALUES (?, ?, ?)
-        ON CONFLICT(user_id, post_id) DO UPDATE SET reaction_type = excluded.reaction_type
-        """,
-        (user["id"], post_id, reaction_type)
-    )
-    conn.commit()
-
-    event_id, payload_json = log_event("REACT_POST", {
-        "post_id": post_id,
-        "user_id": user["id"],
-        "reaction_type": reaction_type,
-    })
-    replicate_event(event_id, "REACT_POST", payload_json)
+    user_id = user["id"]
 
-    if request.headers.get("X-Requested-With") == "XMLHttpRequest":
-        cur.execute(
-            "SELECT reaction_type, COUNT(*) AS c FROM reactions WHERE post_id = ? GROUP BY reaction_type",
-            (post_id,)
+    def tx_fn(tx):
+        tx.cur.execute(
+            """
+            INSERT INTO reactions (user_id, post_id, reaction_type)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, post_id) DO UPDATE SET reaction_type = excluded.reaction_type
+            """,
+            (user_id, post_id, reaction_type)
         )
-        reactions = {r["reaction_type"]: r["c"] for r in cur.fetchall()}
-        cur.execute("SELECT COUNT(*) FROM comments WHERE post_id = ?", (post_id,))
-        comments_count = cur.fetchone()[0]
-        return jsonify({
-            "ok": True,
+        tx.log("REACT_POST", {
             "post_id": post_id,
-            "reactions": reactions,
-            "comments_count": comments_count
+            "user_id": user_id,
+            "reaction_type": reaction_type,
         })
+    write(tx_fn)
+
+    if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        stats = load_post_stats(db.reader().cursor(), [post_id])[0]
+        return jsonify({"ok": True, **stats})
 
     return redirect(url_for("index"))
 
@@ -289,24 +573,28 @@ def comment_post(post_id):
             return jsonify({"ok": False, "error": "empty"}), 400
         return redirect(url_for("index"))
 
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO comments (user_id, post_id, content, parent_comment_id) VALUES (?, ?, ?, ?)",
-        (user["id"], post_id, content, parent_comment_id)
-    )
-    conn.commit()
-    comment_id = cur.lastrowid
-
-    event_id, payload_json = log_event("COMMENT_POST", {
-        "comment_id": comment_id,
-        "post_id": post_id,
-        "user_id": user["id"],
-        "content": content,
-        "parent_comment_id": parent_comment_id,
-    })
-    replicate_event(event_id, "COMMENT_POST", payload_json)
+    user_id = user["id"]
+
+    def tx_fn(tx):
+        tx.cur.execute(
+            "INSERT INTO comments (user_id, post_id, content, parent_comment_id) VALUES (?, ?, ?, ?) "
+            "RETURNING id, created_at",
+            (user_id, post_id, content, parent_comment_id)
+        )
+        comment_id, created_at = tx.cur.fetchone()
+        tx.log("COMMENT_POST", {
+            "comment_id": comment_id,
+            "post_id": post_id,
+            "user_id": user_id,
+            "content": content,
+            "parent_comment_id": parent_comment_id,
+            "created_at": created_at,
+        })
+        return comment_id
+    comment_id = write(tx_fn)
 
     if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        cur = db.reader().cursor()
         cur.execute(
             "SELECT c.content, c.created_at, c.parent_comment_id, u.username "
             "FROM comments c JOIN users u ON c.user_id = u.id "
@@ -314,8 +602,7 @@ def comment_post(post_id):
             (comment_id,)
         )
         row = cur.fetchone()
-        cur.execute("SELECT COUNT(*) FROM comments WHERE post_id = ?", (post_id,))
-        comments_count = cur.fetchone()[0]
+        comments_count = load_comments_count_by_post(cur, [post_id])[post_id]
         return jsonify({
             "ok": True,
             "post_id": post_id,
@@ -324,7 +611,8 @@ def comment_post(post_id):
                 "username": row["username"],
                 "content": row["content"],
                 "created_at": row["created_at"],
-                "parent_comment_id": row["parent_comment_id"]
+                "parent_comment_id": row["parent_comment_id"],
+                "replies": [],
             },
             "comments_count": comments_count
         })
@@ -332,20 +620,20 @@ def comment_post(post_id):
     return redirect(url_for("index"))
 
 
+def _delete_post(tx, post_id):
+    tx.cur.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+    tx.cur.execute("DELETE FROM reactions WHERE post_id = ?", (post_id,))
+    tx.cur.execute("DELETE FROM comments WHERE post_id = ?", (post_id,))
+    tx.log("DELETE_POST", {"post_id": post_id})
+
+
 @app.route("/admin/posts/<int:post_id>/delete", methods=["POST"])
 def delete_post(post_id):
     """Eliminar post como admin (desde cualquier perfil / timeline)."""
     if not is_admin_allowed():
         return "No autorizado (fuera de la red permitida o no eres admin)", 403
 
-    cur = conn.cursor()
-    cur.execute("DELETE FROM posts WHERE id = ?", (post_id,))
-    cur.execute("DELETE FROM reactions WHERE post_id = ?", (post_id,))
-    cur.execute("DELETE FROM comments WHERE post_id = ?", (post_id,))
-    conn.commit()
-
-    event_id, payload_json = log_event("DELETE_POST", {"post_id": post_id})
-    replicate_event(event_id, "DELETE_POST", payload_json)
+    write(lambda tx: _delete_post(tx, post_id))
     return redirect(url_for("index"))
 
 
@@ -356,7 +644,7 @@ def delete_own_post(post_id):
     if not user:
         return redirect(url_for("login"))
 
-    cur = conn.cursor()
+    cur = db.reader().cursor()
     cur.execute("SELECT user_id FROM posts WHERE id = ?", (post_id,))
     row = cur.fetchone()
     if not row:
@@ -364,13 +652,7 @@ def delete_own_post(post_id):
     if row["user_id"] != user["id"]:
         return "No autorizado", 403
 
-    cur.execute("DELETE FROM posts WHERE id = ?", (post_id,))
-    cur.execute("DELETE FROM reactions WHERE post_id = ?", (post_id,))
-    cur.execute("DELETE FROM comments WHERE post_id = ?", (post_id,))
-    conn.commit()
-
-    event_id, payload_json = log_event("DELETE_POST", {"post_id": post_id})
-    replicate_event(event_id, "DELETE_POST", payload_json)
+    write(lambda tx: _delete_post(tx, post_id))
     return redirect(url_for("profile", username=user["username"]))
 
 
@@ -381,7 +663,7 @@ def edit_own_post(post_id):
     if not user:
         return redirect(url_for("login"))
 
-    cur = conn.cursor()
+    cur = db.reader().cursor()
     cur.execute("SELECT * FROM posts WHERE id = ?", (post_id,))
     row = cur.fetchone()
     if not row:
@@ -397,26 +679,27 @@ def edit_own_post(post_id):
             return render_template("edit_post.html", post=post, error="Título y contenido son obligatorios.", user=user)
 
         image_filename = post["image_filename"]
+        image_size = None
         image_file = request.files.get("image")
         if image_file and image_file.filename:
-            filename = secure_filename(image_file.filename)
-            image_path = os.path.join(UPLOAD_FOLDER, filename)
-            image_file.save(image_path)
-            image_filename = filename
-
-        cur.execute(
-            "UPDATE posts SET title = ?, content = ?, image_filename = ? WHERE id = ?",
-            (title, content, image_filename, post_id)
-        )
-        conn.commit()
-
-        event_id, payload_json = log_event("UPDATE_POST", {
-            "post_id": post_id,
-            "title": title,
-            "content": content,
-            "image_filename": image_filename,
-        })
-        replicate_event(event_id, "UPDATE_POST", payload_json)
+            image_filename, image_size = save_upload(image_file)
+
+        def tx_fn(tx):
+            if image_size is not None:
+                register_media(tx.cur, image_filename, image_size)
+            tx.cur.execute(
+                "UPDATE posts SET title = ?, content = ?, image_filename = ? WHERE id = ?",
+                (title, content, image_filename, post_id)
+            )
+            tx.log("UPDATE_POST", {
+                "post_id": post_id,
+                "title": title,
+                "content": content,
+                "image_filename": image_filename,
+            })
+        write(tx_fn)
+        if image_filename != post["image_filename"]:
+            images.submit(media_source("uploads", image_filename), post_id=post_id)
 
         return redirect(url_for("profile", username=user["username"]))
 
@@ -425,31 +708,46 @@ def edit_own_post(post_id):
 
 @app.route("/profile/<username>")
 def profile(username):
-    cur = conn.cursor()
+    before = request.args.get("before")
+    user = current_user()
+    cache_key = ("profile", username, before)
+    if user is None:
+        cached = page_cache.get_page(cache_key)
+        if cached:
+            return cached.html
+
+    cur = db.reader().cursor()
+    events_seen = last_event_id(db.reader())
     cur.execute("SELECT * FROM users WHERE username = ?", (username,))
     user_row = cur.fetchone()
     if not user_row:
         return "Usuario no encontrado", 404
     profile_user = dict(user_row)
 
-    cur.execute("""
-        SELECT p.id, p.title, p.content, p.image_filename, p.created_at,
-               (SELECT COUNT(*) FROM comments c WHERE c.post_id = p.id) AS comments_count
-        FROM posts p
-        WHERE p.user_id = ?
-        ORDER BY p.created_at DESC
-    """, (profile_user["id"],))
-    posts = [dict(row) for row in cur.fetchall()]
+    posts, next_cursor = load_profile_posts(cur, profile_user["id"], before, PAGE_SIZE)
+    attach_image_variants(cur, posts)
+    avatar = media_source("avatars", profile_user["profile_image"])
+    profile_user["image_variants"] = load_image_variants(cur, [avatar]).get(avatar, {})
 
-    user = current_user()
-    return render_template(
+    html = render_template(
         "profile.html",
         profile_user=profile_user,
         posts=posts,
+        next_cursor=next_cursor,
         user=user,
         admin_allowed=is_admin_allowed(),
         restricted=is_restricted(user)
     )
+    if user is None:
+        page_cache.put_page(cache_key, html, [p["id"] for p in posts], events_seen,
+                            profile_user_id=profile_user["id"])
+    return html
+
+
+@app.route("/media/<name>")
+def media_file(name):
+    """Imagen (o variante) guardada por contenido, con caché inmutable."""
+    return send_media(name, MEDIA_FOLDER)
 
 
 @app.route("/profile/upload_avatar", methods=["POST"])
@@ -460,15 +758,19 @@ def upload_avatar():
 
     file = request.files.get("avatar")
     if file and file.filename:
-        filename = secure_filename(f"user{user['id']}_{file.filename}")
-        path = os.path.join(AVATAR_FOLDER, filename)
-        file.save(path)
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE users SET profile_image = ? WHERE id = ?",
-            (filename, user["id"])
-        )
-        conn.commit()
+        filename, size = save_upload(file)
+        user_id = user["id"]
+
+        def tx_fn(tx):
+            register_media(tx.cur, filename, size)
+            tx.cur.execute(
+                "UPDATE users SET profile_image = ? WHERE id = ?",
+                (filename, user_id)
+            )
+            log_user_update(tx, user_id)
+        write(tx_fn)
+        user_cache.invalidate(user_id)
+        images.submit(media_source("avatars", filename), user_id=user["id"])
     return redirect(url_for("profile", username=user["username"]))
 
 
@@ -483,63 +785,119 @@ def restrict_user(user_id):
     except ValueError:
         minutes = 0
 
-    cur = conn.cursor()
+    cur = db.reader().cursor()
     cur.execute("SELECT username FROM users WHERE id = ?", (user_id,))
     row = cur.fetchone()
     if not row:
         return "Usuario no encontrado", 404
     username = row["username"]
 
-    if minutes <= 0:
-        cur.execute("UPDATE users SET restricted_until = NULL WHERE id = ?", (user_id,))
-    else:
-        until = datetime.utcnow() + timedelta(minutes=minutes)
-        cur.execute("UPDATE users SET restricted_until = ? WHERE id = ?", (until.isoformat(), user_id))
-    conn.commit()
+    until = (datetime.utcnow() + timedelta(minutes=minutes)).isoformat() if minutes > 0 else None
+
+    def tx_fn(tx):
+        tx.cur.execute("UPDATE users SET restricted_until = ? WHERE id = ?", (until, user_id))
+        log_user_update(tx, user_id)
+    write(tx_fn)
+    user_cache.invalidate(user_id)
 
     return redirect(url_for("profile", username=username))
 
 
 @app.route("/sync")
 def sync_events():
-    last_id = int(request.args.get("last_event_id", 0))
-    cur = conn.cursor()
+    """Eventos posteriores a last_event_id como NDJSON (una línea por evento).
+
+    Devuelve como mucho `limit` eventos; el cliente repite la llamada con el
+    último id recibido hasta obtener menos de `limit`.
+    """
+    last_id = request.args.get("last_event_id", 0, type=int)
+    limit = request.args.get("limit", SYNC_DEFAULT_LIMIT, type=int)
+    limit = max(1, min(limit, SYNC_MAX_LIMIT))
+
+    cur = db.reader().cursor()
+    cur.execute("SELECT MIN(id) FROM events_log")
+    oldest = cur.fetchone()[0]
+    compacted = oldest - 1 if oldest is not None else last_event_id(db.reader())
+    if last_id < compacted:
+        # esos eventos ya no existen: el cliente debe partir de un snapshot
+        return jsonify({"ok": False, "error": "compacted", "compacted_through": compacted}), 410
+
     cur.execute(
-        "SELECT id, event_type, payload FROM events_log WHERE id > ? ORDER BY id ASC",
-        (last_id,)
+        "SELECT id, event_type, payload FROM events_log WHERE id > ? ORDER BY id ASC LIMIT ?",
+        (last_id, limit)
     )
-    rows = cur.fetchall()
-    events = []
-    for r in rows:
-        events.append({
-            "id": r["id"],
-            "event_type": r["event_type"],
-            "payload": json.loads(r["payload"]),
-        })
-    return jsonify(events)
 
+    def generate():
+        while True:
+            rows = cur.fetchmany(500)
+            if not rows:
+                break
+            # el payload ya es JSON: se pasa tal cual, sin json.loads/dumps
+            yield "".join(
+                '{"id": %d, "event_type": %s, "payload": %s}\n' % (
+                    r["id"], json.dumps(r["event_type"]), r["payload"]
+                )
+                for r in rows
+            )
 
-@app.route("/api/reactions_summary")
-def reactions_summary():
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM posts")
-    post_ids = [row["id"] for row in cur.fetchall()]
+    resp = Response(generate(), mimetype="application/x-ndjson")
+    resp.headers["X-Primary-Event-Id"] = str(last_event_id(db.reader()))
+    return resp
 
-    result = []
-    for pid in post_ids:
-        cur.execute(
-            "SELECT reaction_type, COUNT(*) AS c FROM reactions WHERE post_id = ? GROUP BY reaction_type",
-            (pid,)
-        )
-        reactions = {r["reaction_type"]: r["c"] for r in cur.fetchall()}
-        cur.execute("SELECT COUNT(*) FROM comments WHERE post_id = ?", (pid,))
-        comments_count = cur.fetchone()[0]
-        result.append({
-            "post_id": pid,
-            "reactions": reactions,
-            "comments_count": comments_count
-        })
-    return jsonify(result)
+
+@app.route("/primary/status")
+def primary_status():
+    return jsonify({"role": "primary", "last_event_id": last_event_id(db.reader())})
+
+
+@app.route("/snapshot/latest")
+def snapshot_latest():
+    """Último snapshot para arrancar una réplica; luego sigue con /sync desde su event_id.
+
+    Sólo para réplicas (REPLICATION_SECRET): es una copia completa de la base.
+    """
+    if not has_replication_secret(request):
+        return "No autorizado", 403
+    snap = latest_snapshot(db.reader())
+    if not snap:
+        return "Aún no hay snapshots", 404
+    resp = send_from_directory(os.path.abspath(SNAPSHOT_DIR), snap["filename"],
+                               mimetype="application/vnd.sqlite3")
+    resp.headers["X-Snapshot-Event-Id"] = str(snap["event_id"])
+    return resp
+
+
+@app.route("/api/events/stream")
+def events_stream():
+    """Server-Sent Events con los cambios de posts (reacciones, comentarios, altas, bajas).
+
+    Al reconectar, el navegador manda Last-Event-ID y se reenvía lo perdido.
+    Con SSE_MAX_SUBSCRIBERS conexiones abiertas responde 503: EventSource no
+    reintenta y index.html pasa a sondear.
+    """
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("last_event_id", type=int)
+    sub = broadcaster.subscribe(since)
+    if sub is None:
+        return jsonify({"error": "busy"}), 503, {"Retry-After": "60"}
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            while not sub.closed:
+                try:
+                    yield sub.queue.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    # comentario SSE para que proxies no cierren la conexión
+                    yield ": ping\n\n"
+        finally:
+            broadcaster.unsubscribe(sub)
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
 
 
 if __name__ == "__main__":
@@ -0,0 +1,517 @@
+"""Consultas de lectura compartidas (timeline, perfiles, resúmenes)."""
+import base64
+import re
+import sys
+
+from media import media_source
+
+# SQLite limita el número de parámetros por sentencia; troceamos los IN (...)
+MAX_IN_PARAMS = 500
+
+# Comentarios raíz por post que se cargan con cada página (el resto, a pedido)
+COMMENT_ROOTS_PER_POST = 5
+
+# Coincidencias que se rankean por consulta de búsqueda (posts y comentarios por separado)
+SEARCH_MAX_HITS = 1000
+# Una coincidencia sólo en comentarios rankea por debajo de una en el propio post
+SEARCH_COMMENT_WEIGHT = 0.5
+SEARCH_MAX_TERMS = 8
+
+
+def _chunks(ids, size=MAX_IN_PARAMS):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def _placeholders(ids):
+    return ",".join("?" for _ in ids)
+
+
+# -------------------------------
+# SQL de las consultas calientes (las usan los loaders y check_query_plans)
+# -------------------------------
+def _reactions_sql(n):
+    return (
+        "SELECT post_id, reaction_type, count AS c FROM post_reaction_stats "
+        f"WHERE post_id IN ({_placeholders(range(n))})"
+    )
+
+
+def _comments_count_sql(n):
+    return (
+        "SELECT post_id, comments_count FROM post_stats "
+        f"WHERE post_id IN ({_placeholders(range(n))})"
+    )
+
+
+_COMMENT_COLUMNS = "c.id, c.post_id, c.content, c.created_at, c.parent_comment_id, u.username"
+
+
+# Posts por sentencia de raíces: dos parámetros por post y SQLite admite 500
+# SELECT por compuesto
+COMMENT_ROOTS_CHUNK = 250
+
+
+def _comment_roots_sql(n):
+    # un LIMIT por post: el índice (post_id, parent_comment_id, created_at, id) corta
+    # en las primeras filas aunque el post tenga cientos de miles de comentarios
+    arm = f"""
+        SELECT * FROM (
+            SELECT {_COMMENT_COLUMNS}
+            FROM comments c
+            JOIN users u ON u.id = c.user_id
+            WHERE c.post_id = ? AND c.parent_comment_id IS NULL
+            ORDER BY c.created_at, c.id
+            LIMIT ?
+        )
+    """
+    return " UNION ALL ".join(arm for _ in range(n))
+
+
+_COMMENT_ROOTS_PAGE_SQL = f"""
+    SELECT {_COMMENT_COLUMNS}
+    FROM comments c
+    JOIN users u ON u.id = c.user_id
+    WHERE c.post_id = ? AND c.parent_comment_id IS NULL AND (c.created_at, c.id) > (?, ?)
+    ORDER BY c.created_at, c.id
+    LIMIT ?
+"""
+
+
+def _comment_replies_sql(n):
+    return f"""
+        WITH RECURSIVE tree(id) AS (
+            SELECT id FROM comments WHERE parent_comment_id IN ({_placeholders(range(n))})
+            UNION
+            SELECT c.id FROM comments c JOIN tree ON c.parent_comment_id = tree.id
+        )
+        SELECT {_COMMENT_COLUMNS}
+        FROM tree
+        JOIN comments c ON c.id = tree.id
+        JOIN users u ON u.id = c.user_id
+    """
+
+
+def _image_variants_sql(n):
+    return (
+        "SELECT source, variant, filename, width FROM image_variants "
+        f"WHERE source IN ({_placeholders(range(n))})"
+    )
+
+
+def _timeline_sql(keyset):
+    where = "WHERE (p.created_at, p.id) < (?, ?)" if keyset else ""
+    return f"""
+        SELECT p.id, p.title, p.content, p.image_filename, p.created_at, u.username
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        {where}
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT ?
+    """
+
+
+_POST_SQL = """
+    SELECT p.id, p.user_id, p.title, p.content, p.image_filename, p.created_at, u.username
+    FROM posts p
+    JOIN users u ON p.user_id = u.id
+    WHERE p.id = ?
+"""
+
+
+def _profile_sql(keyset):
+    where = "WHERE p.user_id = ?"
+    if keyset:
+        where += " AND (p.created_at, p.id) < (?, ?)"
+    return f"""
+        SELECT p.id, p.title, p.content, p.image_filename, p.created_at,
+               COALESCE(s.comments_count, 0) AS comments_count
+        FROM posts p
+        LEFT JOIN post_stats s ON s.post_id = p.id
+        {where}
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT ?
+    """
+
+
+def load_reactions_by_post(cur, post_ids):
+    """{post_id: {reaction_type: count}} leído de post_reaction_stats."""
+    result = {pid: {} for pid in post_ids}
+    for chunk in _chunks(list(post_ids)):
+        cur.execute(_reactions_sql(len(chunk)), chunk)
+        for r in cur.fetchall():
+            result[r["post_id"]][r["reaction_type"]] = r["c"]
+    return result
+
+
+def load_comments_count_by_post(cur, post_ids):
+    """{post_id: comments_count} leído de post_stats."""
+    result = {pid: 0 for pid in post_ids}
+    for chunk in _chunks(list(post_ids)):
+        cur.execute(_comments_count_sql(len(chunk)), chunk)
+        for r in cur.fetchall():
+            result[r["post_id"]] = r["comments_count"]
+    return result
+
+
+def load_post_stats(cur, post_ids):
+    """[{post_id, reactions, comments_count}] con los contadores materializados."""
+    reactions = load_reactions_by_post(cur, post_ids)
+    comments = load_comments_count_by_post(cur, post_ids)
+    return [
+        {"post_id": pid, "reactions": reactions[pid], "comments_count": comments[pid]}
+        for pid in post_ids
+    ]
+
+
+# Eventos que cambian los contadores (o la existencia) de un post
+STATS_EVENT_TYPES = ("CREATE_POST", "REACT_POST", "COMMENT_POST", "DELETE_POST")
+
+_POST_CHANGES_SQL = """
+    SELECT post_id FROM post_changes
+    WHERE event_id > ? AND event_id <= ?
+    LIMIT ?
+"""
+
+
+def load_stats_delta(cur, since, last_event_id, post_ids=None, max_posts=5000):
+    """Contadores de los posts tocados por eventos posteriores a `since`.
+
+    Sale de post_changes (último evento por post), que existe igual en el
+    primario y en las réplicas. Si el cliente está demasiado atrasado (antes
+    de post_changes_since o más de `max_posts` posts cambiados) devuelve
+    full=True con los contadores de `post_ids` (los posts que muestra), o None
+    si no los mandó. `deleted` lista los posts del delta (o de `post_ids`)
+    que ya no existen.
+    """
+    cur.execute("SELECT value FROM replica_meta WHERE key = 'post_changes_since'")
+    row = cur.fetchone()
+    covered_since = int(row["value"]) if row else last_event_id
+    changed = None
+    if since is not None and since >= covered_since:
+        cur.execute(_POST_CHANGES_SQL, (since, last_event_id, max_posts + 1))
+        changed = [r["post_id"] for r in cur.fetchall() if r["post_id"] is not None]
+    full = changed is None or len(changed) > max_posts
+    if full:
+        if post_ids is None:
+            return None
+        changed = post_ids
+
+    existing = set()
+    for chunk in _chunks(changed):
+        cur.execute(
+            f"SELECT post_id FROM post_stats WHERE post_id IN ({_placeholders(chunk)})", chunk
+        )
+        existing.update(r["post_id"] for r in cur.fetchall())
+    alive = [pid for pid in changed if pid in existing]
+    return {
+        "full": full,
+        "posts": load_post_stats(cur, alive),
+        "deleted": [pid for pid in changed if pid not in existing],
+    }
+
+
+def load_image_variants(cur, sources):
+    """{source: {variant: {filename, width}}} para las imágenes ya procesadas."""
+    sources = list({s for s in sources if s})
+    result = {}
+    for chunk in _chunks(sources):
+        cur.execute(_image_variants_sql(len(chunk)), chunk)
+        for r in cur.fetchall():
+            result.setdefault(r["source"], {})[r["variant"]] = {
+                "filename": r["filename"],
+                "width": r["width"],
+            }
+    return result
+
+
+def attach_image_variants(cur, posts):
+    """Agrega image_variants a cada post con imagen ({} si aún no se procesó)."""
+    sources = {p["id"]: media_source("uploads", p["image_filename"]) for p in posts if p.get("image_filename")}
+    variants = load_image_variants(cur, sources.values())
+    for p in posts:
+        p["image_variants"] = variants.get(sources.get(p["id"]), {})
+    return posts
+
+
+def attach_post_details(cur, posts, roots_per_post=COMMENT_ROOTS_PER_POST):
+    """Agrega reactions_by_type, comments (árbol), comments_count e image_variants
+    a cada post con un número fijo de consultas."""
+    post_ids = [p["id"] for p in posts]
+    if not post_ids:
+        return posts
+    reactions = load_reactions_by_post(cur, post_ids)
+    counts = load_comments_count_by_post(cur, post_ids)
+    trees = load_comment_trees(cur, post_ids, roots_per_post)
+    for p in posts:
+        p["reactions_by_type"] = reactions[p["id"]]
+        p["comments_count"] = counts[p["id"]]
+        p["comments"], p["comments_next_cursor"] = trees[p["id"]]
+    attach_image_variants(cur, posts)
+    return posts
+
+
+def encode_cursor(post):
+    """Cursor opaco (created_at, id) del último post (o comentario) de una página."""
+    raw = f"{post['created_at']}|{post['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Devuelve (created_at, id) o None si el cursor no es válido."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, post_id = raw.rsplit("|", 1)
+        return created_at, int(post_id)
+    except Exception:
+        return None
+
+
+# -------------------------------
+# Árbol de comentarios
+# -------------------------------
+def _comment_order(c):
+    return c["created_at"], c["id"]
+
+
+def build_comment_trees(roots, replies):
+    """Cuelga `replies` (a cualquier profundidad) de `roots` en una pasada lineal.
+
+    Cada comentario queda con su lista `replies` en orden cronológico.
+    """
+    nodes = {}
+    for c in roots:
+        c["replies"] = []
+        nodes[c["id"]] = c
+    replies = sorted(replies, key=_comment_order)
+    for c in replies:
+        c["replies"] = []
+        nodes[c["id"]] = c
+    for c in replies:
+        parent = nodes.get(c["parent_comment_id"])
+        if parent is not None:
+            parent["replies"].append(c)
+    return roots
+
+
+def _load_replies(cur, root_ids):
+    replies = []
+    for chunk in _chunks(list(root_ids)):
+        cur.execute(_comment_replies_sql(len(chunk)), chunk)
+        replies.extend(dict(r) for r in cur.fetchall())
+    return replies
+
+
+def load_comment_trees(cur, post_ids, roots_per_post=COMMENT_ROOTS_PER_POST):
+    """{post_id: (primeros comentarios raíz con sus respuestas, cursor de los siguientes)}.
+
+    Dos consultas (raíces y descendientes) por trozo de posts, sin importar
+    cuántos comentarios ni qué profundidad tenga cada uno.
+    """
+    roots = {pid: [] for pid in post_ids}
+    for chunk in _chunks(list(post_ids), COMMENT_ROOTS_CHUNK):
+        # uno de más por post para saber si hay otra página
+        params = [v for pid in chunk for v in (pid, roots_per_post + 1)]
+        cur.execute(_comment_roots_sql(len(chunk)), params)
+        for r in cur.fetchall():
+            roots[r["post_id"]].append(dict(r))
+
+    result = {}
+    shown_all = []
+    for pid, post_roots in roots.items():
+        post_roots.sort(key=_comment_order)
+        shown, next_cursor = _page(post_roots, roots_per_post)
+        result[pid] = (shown, next_cursor)
+        shown_all.extend(shown)
+    build_comment_trees(shown_all, _load_replies(cur, [c["id"] for c in shown_all]))
+    return result
+
+
+def load_comment_page(cur, post_id, after=None, limit=20):
+    """Siguientes `limit` comentarios raíz de un post (con sus respuestas) tras el cursor `after`."""
+    key = decode_cursor(after) or ("", 0)
+    cur.execute(_COMMENT_ROOTS_PAGE_SQL, (post_id, key[0], key[1], limit + 1))
+    shown, next_cursor = _page([dict(r) for r in cur.fetchall()], limit)
+    build_comment_trees(shown, _load_replies(cur, [c["id"] for c in shown]))
+    return shown, next_cursor
+
+
+def _page(posts, limit):
+    """Recorta la fila extra pedida y calcula el cursor de la siguiente página."""
+    if len(posts) > limit:
+        posts = posts[:limit]
+        return posts, encode_cursor(posts[-1])
+    return posts, None
+
+
+def load_timeline(cur, before=None, limit=20, with_details=True):
+    """Una página del timeline (keyset sobre created_at, id) con reacciones y comentarios.
+
+    Con with_details=False devuelve sólo las filas de posts; el llamador
+    completa con attach_post_details() los que realmente vaya a renderizar.
+    """
+    key = decode_cursor(before)
+    params = list(key) if key else []
+    cur.execute(_timeline_sql(bool(key)), params + [limit + 1])
+    posts, next_cursor = _page([dict(row) for row in cur.fetchall()], limit)
+    if with_details:
+        attach_post_details(cur, posts)
+    return posts, next_cursor
+
+
+def load_post(cur, post_id):
+    """Un post con reacciones, comentarios y variantes de imagen, o None."""
+    cur.execute(_POST_SQL, (post_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return attach_post_details(cur, [dict(row)])[0]
+
+
+def load_profile_posts(cur, user_id, before=None, limit=20):
+    """Una página de posts de un usuario con su conteo de comentarios."""
+    key = decode_cursor(before)
+    params = [user_id] + (list(key) if key else [])
+    cur.execute(_profile_sql(bool(key)), params + [limit + 1])
+    return _page([dict(row) for row in cur.fetchall()], limit)
+
+
+# -------------------------------
+# Búsqueda (FTS5)
+# -------------------------------
+# rank de FTS5 es bm25 negativo: cuanto menor, más relevante.
+# Cada rama toma sus mejores SEARCH_MAX_HITS (FTS5 resuelve ORDER BY rank LIMIT
+# sin ordenar todo) y cada post queda con su mejor puntaje.
+_SEARCH_SQL = """
+    WITH hits(post_id, score) AS (
+        SELECT * FROM (
+            SELECT rowid, rank FROM posts_fts WHERE posts_fts MATCH :q ORDER BY rank LIMIT :max_hits
+        )
+        UNION ALL
+        SELECT c.post_id, m.rank * :comment_weight
+        FROM (
+            SELECT rowid, rank FROM comments_fts WHERE comments_fts MATCH :q ORDER BY rank LIMIT :max_hits
+        ) m
+        JOIN comments c ON c.id = m.rowid
+    ),
+    ranked(post_id, score) AS (
+        SELECT post_id, MIN(score) FROM hits GROUP BY post_id
+    )
+    SELECT p.id, p.title, p.content, p.image_filename, p.created_at, u.username, r.score
+    FROM ranked r
+    JOIN posts p ON p.id = r.post_id
+    JOIN users u ON u.id = p.user_id
+    WHERE (r.score, r.post_id) > (:score, :post_id)
+    ORDER BY r.score, r.post_id
+    LIMIT :limit
+"""
+
+
+def search_match_query(text):
+    """Texto libre -> consulta MATCH de FTS5, o None si no queda ningún término.
+
+    Cada palabra va entre comillas (la sintaxis de FTS5 del usuario no llega
+    al MATCH) y la última se busca como prefijo: "gol" "leo"*.
+    """
+    terms = re.findall(r"\w+", text or "")[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{t}"' for t in terms) + "*"
+
+
+def encode_search_cursor(post):
+    raw = f"{post['score']!r}|{post['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor):
+    """Devuelve (score, id) o None si el cursor no es válido."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        score, post_id = raw.rsplit("|", 1)
+        return float(score), int(post_id)
+    except Exception:
+        return None
+
+
+def load_search(cur, text, after=None, limit=20):
+    """Una página de posts que coinciden con `text` (en el post o en sus comentarios), por relevancia.
+
+    Paginación keyset sobre (score, id) del ranking actual. bm25 depende de
+    estadísticas de todo el índice, así que si entran o cambian posts y
+    comentarios entre una página y la siguiente los scores se mueven: un post
+    puede repetirse o saltarse. No hay orden estable que prometer; el cliente
+    descarta los ids que ya mostró.
+    """
+    match = search_match_query(text)
+    if match is None:
+        return [], None
+    key = decode_search_cursor(after) or (float("-inf"), 0)
+    cur.execute(_SEARCH_SQL, {
+        "q": match, "max_hits": SEARCH_MAX_HITS, "comment_weight": SEARCH_COMMENT_WEIGHT,
+        "score": key[0], "post_id": key[1], "limit": limit + 1,
+    })
+    posts = [dict(row) for row in cur.fetchall()]
+    if len(posts) > limit:
+        posts = posts[:limit]
+        return posts, encode_search_cursor(posts[-1])
+    return posts, None
+
+
+# -------------------------------
+# Verificación de planes de consulta
+# -------------------------------
+HOT_QUERIES = {
+    "timeline": (_timeline_sql(False), (21,)),
+    "timeline_keyset": (_timeline_sql(True), ("2024-01-01 00:00:00", 1, 21)),
+    "profile": (_profile_sql(False), (1, 21)),
+    "profile_keyset": (_profile_sql(True), (1, "2024-01-01 00:00:00", 1, 21)),
+    "reactions_by_post": (_reactions_sql(3), (1, 2, 3)),
+    "comments_count_by_post": (_comments_count_sql(3), (1, 2, 3)),
+    "comment_roots": (_comment_roots_sql(3), (1, 6, 2, 6, 3, 6)),
+    "comment_roots_page": (_COMMENT_ROOTS_PAGE_SQL, (1, "2024-01-01 00:00:00", 1, 21)),
+    "comment_replies": (_comment_replies_sql(3), (1, 2, 3)),
+    "post_changes": (_POST_CHANGES_SQL, (10, 20, 5001)),
+    "image_variants": (_image_variants_sql(2), ("uploads/a.jpg", "uploads/b.jpg")),
+}
+
+
+def check_query_plans(conn, queries=HOT_QUERIES):
+    """EXPLAIN QUERY PLAN de las consultas calientes.
+
+    Devuelve una lista de (nombre, detalle) con cada recorrido completo de
+    tabla o ordenamiento en B-tree temporal; vacía si todo usa índices.
+    Recorrer subconsultas o CTE ya materializadas no cuenta como problema.
+    """
+    problems = []
+    for name, (sql, params) in queries.items():
+        derived = set()
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[3]
+            if detail.startswith(("MATERIALIZE ", "CO-ROUTINE ")):
+                derived.add(detail.split(" ", 1)[1])
+                continue
+            scanned = detail[len("SCAN "):]
+            full_scan = (
+                detail.startswith("SCAN ") and " USING " not in detail
+                and scanned not in derived and not scanned.startswith("(subquery-")
+            )
+            if full_scan or "TEMP B-TREE" in detail:
+                problems.append((name, detail))
+    return problems
+
+
+if __name__ == "__main__":
+    # uso: python queries.py db/primary.db  -> sale con 1 si alguna consulta hace SCAN
+    from db_utils import get_connection, init_db
+
+    conn = get_connection(sys.argv[1] if len(sys.argv) > 1 else "db/primary.db")
+    init_db(conn)
+    problems = check_query_plans(conn)
+    for name, detail in problems:
+        print(f"{name}: {detail}")
+    sys.exit(1 if problems else 0)
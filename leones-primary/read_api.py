@@ -0,0 +1,159 @@
+"""API JSON de sólo lectura, común al primario y a las réplicas.
+
+Cada respuesta lleva el event_id aplicado por el servidor que la generó (en
+el cuerpo y en X-Event-Id). Con ?min_event_id=N el cliente pide leer sus
+propias escrituras: si el servidor aún no llegó a N espera un momento y,
+si sigue atrasado, responde 503 para que se reintente en otro lado.
+"""
+from flask import Blueprint, Response, jsonify, request
+
+from queries import (
+    attach_image_variants, load_comment_page, load_post, load_profile_posts, load_search, load_stats_delta,
+    load_timeline,
+)
+
+# Máximo de posts por página que puede pedir un cliente
+MAX_PAGE_SIZE = 100
+DEFAULT_PAGE_SIZE = 20
+
+# Posts que puede listar ?posts= en /api/reactions_summary
+MAX_STATS_POSTS = 500
+
+# Segundos que se espera a que llegue min_event_id antes de responder 503
+MIN_EVENT_WAIT = 1.0
+
+
+def create_read_api(db, applied_event_id, wait_for_event=None):
+    """Blueprint con /api/timeline, /api/profile, /api/posts (y sus comentarios), /api/search y /api/reactions_summary.
+
+    `applied_event_id()` devuelve el último evento visible en `db`;
+    `wait_for_event(n, timeout)` (sólo en réplicas) bloquea hasta aplicar `n`
+    o vencer el plazo y devuelve el event_id alcanzado.
+    """
+    bp = Blueprint("read_api", __name__)
+
+    def _snapshot_event_id():
+        """event_id leído antes de consultar: los datos son al menos así de nuevos."""
+        current = applied_event_id()
+        wanted = request.args.get("min_event_id", type=int)
+        # en el primario (sin wait_for_event) todo evento confirmado ya es visible
+        if wanted is None or wanted <= current or wait_for_event is None:
+            return current, None
+        current = wait_for_event(wanted, MIN_EVENT_WAIT)
+        if current >= wanted:
+            return current, None
+        resp = jsonify({"error": "stale", "event_id": current, "min_event_id": wanted})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = "1"
+        resp.headers["X-Event-Id"] = str(current)
+        return current, resp
+
+    def _respond(event_id, body, status=200):
+        resp = jsonify({"event_id": event_id, **body})
+        resp.status_code = status
+        resp.headers["X-Event-Id"] = str(event_id)
+        return resp
+
+    def _post_ids():
+        raw = request.args.get("posts")
+        if raw is None:
+            return None
+        ids = []
+        for part in raw.split(",")[:MAX_STATS_POSTS]:
+            if part.strip().isdigit():
+                ids.append(int(part))
+        return ids
+
+    def _limit():
+        limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+        return max(1, min(limit, MAX_PAGE_SIZE))
+
+    @bp.route("/api/timeline")
+    def timeline():
+        event_id, stale = _snapshot_event_id()
+        if stale:
+            return stale
+        posts, next_cursor = load_timeline(db.reader().cursor(), request.args.get("before"), _limit())
+        return _respond(event_id, {"posts": posts, "next_cursor": next_cursor})
+
+    @bp.route("/api/profile/<username>")
+    def profile(username):
+        event_id, stale = _snapshot_event_id()
+        if stale:
+            return stale
+        cur = db.reader().cursor()
+        cur.execute(
+            "SELECT id, username, profile_image, created_at FROM users WHERE username = ?",
+            (username,)
+        )
+        row = cur.fetchone()
+        if not row:
+            return _respond(event_id, {"error": "Usuario no encontrado"}, 404)
+        posts, next_cursor = load_profile_posts(cur, row["id"], request.args.get("before"), _limit())
+        attach_image_variants(cur, posts)
+        return _respond(event_id, {"user": dict(row), "posts": posts, "next_cursor": next_cursor})
+
+    @bp.route("/api/posts/<int:post_id>")
+    def post(post_id):
+        event_id, stale = _snapshot_event_id()
+        if stale:
+            return stale
+        found = load_post(db.reader().cursor(), post_id)
+        if found is None:
+            return _respond(event_id, {"error": "Post no encontrado"}, 404)
+        return _respond(event_id, {"post": found})
+
+    @bp.route("/api/posts/<int:post_id>/comments")
+    def post_comments(post_id):
+        """Página de comentarios raíz (con sus respuestas) tras ?after=<cursor>."""
+        event_id, stale = _snapshot_event_id()
+        if stale:
+            return stale
+        comments, next_cursor = load_comment_page(
+            db.reader().cursor(), post_id, request.args.get("after"), _limit()
+        )
+        return _respond(event_id, {"post_id": post_id, "comments": comments, "next_cursor": next_cursor})
+
+    @bp.route("/api/search")
+    def search():
+        """Posts que coinciden con ?q= (título, contenido o comentarios), del más relevante al menos."""
+        event_id, stale = _snapshot_event_id()
+        if stale:
+            return stale
+        query = request.args.get("q", "").strip()
+        cur = db.reader().cursor()
+        posts, next_cursor = load_search(cur, query, request.args.get("after"), _limit())
+        attach_image_variants(cur, posts)
+        return _respond(event_id, {"query": query, "posts": posts, "next_cursor": next_cursor})
+
+    @bp.route("/api/reactions_summary")
+    def reactions_summary():
+        """Contadores por post en modo incremental.
+
+        ?since=<event_id> devuelve sólo los posts que cambiaron desde ese evento
+        (o 304 si no hubo ninguno). La versión es el último evento aplicado y
+        viaja también como ETag. ?posts=1,2,3 son los posts que muestra el
+        cliente: si está demasiado atrasado para un delta se devuelven sólo
+        ésos, y sin la lista, 410 para que recargue la página.
+        """
+        current, stale = _snapshot_event_id()
+        if stale:
+            return stale
+        etag = f'W/"ev-{current}"'
+        since = request.args.get("since", type=int)
+        post_ids = _post_ids()
+        if since == current or etag in request.headers.get("If-None-Match", ""):
+            resp = Response(status=304)
+        else:
+            delta = load_stats_delta(db.reader().cursor(), since, current, post_ids)
+            if delta is None:
+                resp = jsonify({"error": "gone", "event_id": current})
+                resp.status_code = 410
+            else:
+                resp = jsonify({"last_event_id": current, "event_id": current, **delta})
+        resp.headers["ETag"] = etag
+        resp.headers["Cache-Control"] = "no-cache"
+        resp.headers["X-Event-Id"] = str(current)
+        return resp
+
+    return bp
@@ -2,125 +2,524 @@ from flask import Flask, request, jsonify
 import sqlite3
 import json
 import os
+import threading
+import time
 
-from db_utils import get_connection, init_db
+import requests
+
+import metrics
+from db_utils import ConnectionPool, init_db
+from media import (
+    MEDIA_FOLDER, ChecksumMismatch, append_chunk, is_stored_name, pull_media, referenced_media,
+    send_media, stored_media, transfer_offset,
+)
+from queries import STATS_EVENT_TYPES, check_query_plans
+from read_api import create_read_api
+from replication import has_replication_secret, secret_headers
 
 REPLICA_NAME = os.environ.get("REPLICA_NAME", "Replica")
 DB_PATH = os.path.join("db", f"{REPLICA_NAME}.db")
 
+# Si se define, al arrancar la réplica se pone al día leyendo /sync del primario
+PRIMARY_URL = os.environ.get("PRIMARY_URL")
+SYNC_PAGE_SIZE = int(os.environ.get("SYNC_PAGE_SIZE", 1000))
+SYNC_APPLY_BATCH = 200
+
+# Copia local de static/media (la llenan el primario y catch_up)
+MEDIA_ROOT = os.environ.get("MEDIA_ROOT", MEDIA_FOLDER)
+
 app = Flask(__name__)
 
-conn = get_connection(DB_PATH)
-init_db(conn)
+# Antes de abrir la primera conexión: así todas quedan instrumentadas
+metrics.init_app(app, REPLICA_NAME)
+
+db = ConnectionPool(DB_PATH)
+init_db(db.writer())
+
+# Avisar si alguna consulta caliente dejó de usar sus índices
+for name, detail in check_query_plans(db.reader()):
+    print(f"[{REPLICA_NAME}] plan de consulta degradado en {name}: {detail}")
+db.release()
+
+
+@app.after_request
+def release_connections(resp):
+    """Devuelve las conexiones del hilo al pool cuando termina la respuesta (incluido un stream)."""
+    resp.call_on_close(db.release)
+    return resp
+
+
+# Serializa la aplicación de lotes: el high-water mark se lee y escribe dentro
+apply_lock = threading.Lock()
+
+# Avisa a las lecturas con min_event_id cada vez que avanza el high-water mark
+applied = threading.Condition()
+
+# Último event_id del primario que conocemos (X-Primary-Event-Id de /replicate y /sync)
+primary_event_id = 0
+last_apply_at = None
+
+APPLY_SECONDS = metrics.histogram(
+    "leones_replica_apply_seconds", "Duración de cada lote aplicado")
+EVENTS_APPLIED = metrics.counter(
+    "leones_replica_events_applied_total", "Eventos aplicados")
+
+
+class EventGap(Exception):
+    """El lote no continúa desde el último evento aplicado."""
+
+    def __init__(self, last_event_id, next_event_id):
+        super().__init__(f"se esperaba el evento {last_event_id + 1}, llegó {next_event_id}")
+        self.last_event_id = last_event_id
+        self.next_event_id = next_event_id
+
+
+def get_last_event_id(conn=None):
+    cur = (conn or db.reader()).cursor()
+    cur.execute("SELECT value FROM replica_meta WHERE key = 'last_event_id'")
+    row = cur.fetchone()
+    return int(row["value"]) if row else 0
+
+
+def wait_for_event(event_id, timeout):
+    """Espera (hasta `timeout` s) a que se aplique `event_id`; devuelve el alcanzado."""
+    with applied:
+        applied.wait_for(lambda: get_last_event_id() >= event_id, timeout)
+    return get_last_event_id()
+
+
+def _notify_applied():
+    with applied:
+        applied.notify_all()
 
 
-def apply_event(event_type, payload):
-    cur = conn.cursor()
+def _note_primary_event_id(value):
+    global primary_event_id
+    if value is not None and value > primary_event_id:
+        primary_event_id = value
 
-    # -------------------------------
+
+def _lag_events():
+    return max(0, primary_event_id - get_last_event_id())
+
+
+def _seconds_since_apply():
+    return time.time() - last_apply_at if last_apply_at else -1
+
+
+metrics.gauge("leones_last_event_id", "Último evento aplicado").set_function(get_last_event_id)
+metrics.gauge(
+    "leones_replica_lag_events", "Eventos que el primario ya tiene y esta réplica todavía no"
+).set_function(_lag_events)
+metrics.gauge(
+    "leones_replica_seconds_since_apply", "Segundos desde el último lote aplicado (-1: ninguno)"
+).set_function(_seconds_since_apply)
+
+
+def _set_last_event_id(cur, event_id):
+    cur.execute(
+        """
+        INSERT INTO replica_meta (key, value) VALUES ('last_event_id', ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """,
+        (str(event_id),)
+    )
+
+
+# -------------------------------
+# Sentencias por tipo de evento: (lista de SQL, función payload -> parámetros)
+# -------------------------------
+EVENT_STATEMENTS = {
     # 1. Crear post
-    # -------------------------------
-    if event_type == "CREATE_POST":
-        cur.execute(
+    "CREATE_POST": (
+        [
             """
             INSERT OR IGNORE INTO posts (id, user_id, title, content, image_filename, created_at)
-            VALUES (?, ?, ?, ?, ?, datetime('now'))
+            VALUES (?, ?, ?, ?, ?, COALESCE(?, datetime('now')))
             """,
-            (
-                payload["post_id"],
-                payload["user_id"],
-                payload["title"],
-                payload["content"],
-                payload.get("image_filename"),
-            )
-        )
-        conn.commit()
-
-    # -------------------------------
+        ],
+        lambda p: (
+            p["post_id"],
+            p["user_id"],
+            p["title"],
+            p["content"],
+            p.get("image_filename"),
+            # la del primario (eventos viejos no la traen)
+            p.get("created_at"),
+        ),
+    ),
     # 2. Reacción
-    # -------------------------------
-    elif event_type == "REACT_POST":
-        cur.execute(
+    "REACT_POST": (
+        [
             """
             INSERT INTO reactions (user_id, post_id, reaction_type)
             VALUES (?, ?, ?)
             ON CONFLICT(user_id, post_id)
             DO UPDATE SET reaction_type = excluded.reaction_type
             """,
-            (
-                payload["user_id"],
-                payload["post_id"],
-                payload["reaction_type"],
-            )
-        )
-        conn.commit()
-
-    # -------------------------------
+        ],
+        lambda p: (
+            p["user_id"],
+            p["post_id"],
+            p["reaction_type"],
+        ),
+    ),
     # 3. Comentario
-    # -------------------------------
-    elif event_type == "COMMENT_POST":
-        cur.execute(
+    "COMMENT_POST": (
+        [
             """
             INSERT OR IGNORE INTO comments (id, user_id, post_id, content, parent_comment_id, created_at)
-            VALUES (?, ?, ?, ?, ?, datetime('now'))
+            VALUES (?, ?, ?, ?, ?, COALESCE(?, datetime('now')))
             """,
-            (
-                payload["comment_id"],
-                payload["user_id"],
-                payload["post_id"],
-                payload["content"],
-                payload.get("parent_comment_id"),
-            )
-        )
-        conn.commit()
-
-    # -------------------------------
+        ],
+        lambda p: (
+            p["comment_id"],
+            p["user_id"],
+            p["post_id"],
+            p["content"],
+            p.get("parent_comment_id"),
+            p.get("created_at"),
+        ),
+    ),
     # 4. Actualizar post (EDICIÓN)
-    # -------------------------------
-    elif event_type == "UPDATE_POST":
-        cur.execute(
+    "UPDATE_POST": (
+        [
             """
             UPDATE posts
             SET title = ?, content = ?, image_filename = ?
             WHERE id = ?
             """,
-            (
-                payload["title"],
-                payload["content"],
-                payload.get("image_filename"),
-                payload["post_id"],
-            )
+        ],
+        lambda p: (
+            p["title"],
+            p["content"],
+            p.get("image_filename"),
+            p["post_id"],
+        ),
+    ),
+    # 5. Eliminar post
+    "DELETE_POST": (
+        [
+            "DELETE FROM posts WHERE id = ?",
+            "DELETE FROM reactions WHERE post_id = ?",
+            "DELETE FROM comments WHERE post_id = ?",
+        ],
+        lambda p: (p["post_id"],),
+    ),
+    # 6. Alta de usuario (sin hash de contraseña: las réplicas no autentican)
+    "CREATE_USER": (
+        [
+            """
+            INSERT OR IGNORE INTO users (id, username, password_hash, role, created_at)
+            VALUES (?, ?, '', ?, COALESCE(?, datetime('now')))
+            """,
+        ],
+        lambda p: (
+            p["user_id"],
+            p["username"],
+            p.get("role", "user"),
+            p.get("created_at"),
+        ),
+    ),
+    # 7. Cambios de usuario (avatar, restricción, rol)
+    "UPDATE_USER": (
+        [
+            """
+            UPDATE users
+            SET profile_image = ?, restricted_until = ?, role = ?
+            WHERE id = ?
+            """,
+        ],
+        lambda p: (
+            p.get("profile_image"),
+            p.get("restricted_until"),
+            p.get("role", "user"),
+            p["user_id"],
+        ),
+    ),
+    # 8. Variantes redimensionadas de una imagen
+    "MEDIA_VARIANTS": (
+        [
+            """
+            INSERT OR REPLACE INTO image_variants (source, variant, filename, width, height, sha256)
+            SELECT ?, json_extract(value, '$.variant'), json_extract(value, '$.filename'),
+                   json_extract(value, '$.width'), json_extract(value, '$.height'),
+                   json_extract(value, '$.sha256')
+            FROM json_each(?)
+            """,
+        ],
+        lambda p: (
+            p["source"],
+            json.dumps(p["variants"]),
+        ),
+    ),
+}
+
+
+def _runs_by_type(events):
+    """Agrupa eventos consecutivos del mismo tipo sin alterar el orden global."""
+    run_type, run = None, []
+    for ev in events:
+        if ev["event_type"] != run_type and run:
+            yield run_type, run
+            run = []
+        run_type = ev["event_type"]
+        run.append(ev)
+    if run:
+        yield run_type, run
+
+
+def apply_events(events):
+    """Aplica en orden y en una sola transacción los eventos posteriores al high-water mark.
+
+    Los eventos ya aplicados se ignoran. Si el lote deja un hueco se aplica el
+    tramo contiguo y se lanza EventGap para que el emisor reenvíe desde ahí.
+    Devuelve el último event_id aplicado.
+    """
+    global last_apply_at
+    started = time.perf_counter()
+    with apply_lock:
+        conn = db.writer()
+        last_event_id = get_last_event_id(conn)
+        pending = sorted(
+            (ev for ev in events if ev["event_id"] > last_event_id),
+            key=lambda ev: ev["event_id"]
         )
-        conn.commit()
+        contiguous = []
+        for ev in pending:
+            if ev["event_id"] == last_event_id + len(contiguous) + 1:
+                contiguous.append(ev)
+            elif ev["event_id"] > last_event_id + len(contiguous) + 1:
+                break
 
-    # -------------------------------
-    # 5. Eliminar post
-    # -------------------------------
-    elif event_type == "DELETE_POST":
-        pid = payload["post_id"]
-        cur.execute("DELETE FROM posts WHERE id = ?", (pid,))
-        cur.execute("DELETE FROM reactions WHERE post_id = ?", (pid,))
-        cur.execute("DELETE FROM comments WHERE post_id = ?", (pid,))
-        conn.commit()
+        if contiguous:
+            cur = conn.cursor()
+            with conn:
+                for event_type, run in _runs_by_type(contiguous):
+                    spec = EVENT_STATEMENTS.get(event_type)
+                    if spec is None:
+                        print(f"[{REPLICA_NAME}] Evento no reconocido:", event_type)
+                        continue
+                    statements, params = spec
+                    rows = [params(ev["payload"]) for ev in run]
+                    for sql in statements:
+                        cur.executemany(sql, rows)
+                # lo que en el primario hace el trigger de events_log (delta de /api/reactions_summary)
+                cur.executemany(
+                    """
+                    INSERT INTO post_changes (post_id, event_id) VALUES (?, ?)
+                    ON CONFLICT(post_id) DO UPDATE SET event_id = excluded.event_id
+                    """,
+                    [
+                        (ev["payload"]["post_id"], ev["event_id"])
+                        for ev in contiguous
+                        if ev["event_type"] in STATS_EVENT_TYPES and ev["payload"].get("post_id") is not None
+                    ]
+                )
+                last_event_id = contiguous[-1]["event_id"]
+                _set_last_event_id(cur, last_event_id)
+            _notify_applied()
+            APPLY_SECONDS.observe(time.perf_counter() - started)
+            EVENTS_APPLIED.inc(len(contiguous))
+            last_apply_at = time.time()
 
-    else:
-        print(f"[{REPLICA_NAME}] Evento no reconocido:", event_type)
+        if len(contiguous) < len(pending):
+            raise EventGap(last_event_id, pending[len(contiguous)]["event_id"])
+        return last_event_id
+
+
+def restore_snapshot(primary_url):
+    """Reemplaza el contenido de la BD por el último snapshot del primario."""
+    resp = requests.get(f"{primary_url}/snapshot/latest", headers=secret_headers(), stream=True, timeout=60)
+    resp.raise_for_status()
+    tmp_path = DB_PATH + ".snapshot"
+    with open(tmp_path, "wb") as f:
+        for chunk in resp.iter_content(chunk_size=1024 * 1024):
+            f.write(chunk)
+
+    snap = sqlite3.connect(tmp_path)
+    try:
+        with apply_lock:
+            snap.backup(db.writer())
+    finally:
+        snap.close()
+        os.remove(tmp_path)
+    _pull_media(primary_url, stored_media(db.reader().cursor()))
+    _notify_applied()
+    return get_last_event_id()
+
+
+def _pull_media(primary_url, refs, session=None):
+    """Trae del primario los archivos de media que falten (reanuda los .part)."""
+    session = session or requests.Session()
+    for name, sha256 in refs:
+        try:
+            pull_media(session, primary_url, name, sha256, MEDIA_ROOT)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            # el primario ya lo recolectó: ningún post vigente lo usa
+
+
+def catch_up(primary_url, page_size=SYNC_PAGE_SIZE):
+    """Descarga y aplica /sync desde el high-water mark hasta quedar al día.
+
+    Cada lote aplicado mueve replica_meta.last_event_id, así que si se corta
+    la transferencia basta con volver a llamar para continuar donde quedó.
+    Si el primario ya compactó esa parte del log, arranca desde su snapshot.
+    """
+    session = requests.Session()
+    while True:
+        since = get_last_event_id()
+        resp = session.get(
+            f"{primary_url}/sync",
+            params={"last_event_id": since, "limit": page_size},
+            stream=True,
+            timeout=30,
+        )
+        if resp.status_code == 410:
+            # el primario ya compactó esos eventos: partimos de su snapshot
+            restored = restore_snapshot(primary_url)
+            print(f"[{REPLICA_NAME}] restaurado snapshot hasta el evento {restored}")
+            continue
+        resp.raise_for_status()
+        _note_primary_event_id(int(resp.headers.get("X-Primary-Event-Id", 0)))
+
+        received = 0
+        batch = []
+        for line in resp.iter_lines():
+            if not line:
+                continue
+            ev = json.loads(line)
+            batch.append({
+                "event_id": ev["id"],
+                "event_type": ev["event_type"],
+                "payload": ev["payload"],
+            })
+            received += 1
+            if len(batch) >= SYNC_APPLY_BATCH:
+                _apply_with_media(primary_url, batch, session)
+                batch = []
+        if batch:
+            _apply_with_media(primary_url, batch, session)
+
+        print(f"[{REPLICA_NAME}] sync: {received} eventos tras {since}")
+        if received < page_size:
+            return get_last_event_id()
+
+
+def _apply_with_media(primary_url, batch, session):
+    refs = [ref for ev in batch for ref in referenced_media(ev["event_type"], ev["payload"])]
+    _pull_media(primary_url, refs, session)
+    apply_events(batch)
+
+
+def _catch_up_on_start(primary_url, retries=5):
+    for attempt in range(retries):
+        try:
+            last = catch_up(primary_url)
+            print(f"[{REPLICA_NAME}] al día con el primario en el evento {last}")
+            return
+        except EventGap as gap:
+            print(f"[{REPLICA_NAME}] sync detenido:", gap)
+            return
+        except Exception as e:
+            print(f"[{REPLICA_NAME}] sync falló ({e}), reintentando...")
+            time.sleep(2 ** attempt)
+
+
+# Lecturas (timeline, perfil, post, contadores) con el event_id aplicado
+app.register_blueprint(create_read_api(db, get_last_event_id, wait_for_event))
 
 
 @app.route("/replicate", methods=["POST"])
 def replicate():
-    data = request.get_json()
+    """Acepta una lista ordenada de eventos (o un solo evento, formato anterior).
+
+    Sólo del primario: un evento aplicado mueve el high-water mark y el
+    verdadero con ese event_id se descartaría después como duplicado.
+    """
+    if not has_replication_secret(request):
+        return "No autorizado", 403
+    data = request.get_json(silent=True)
     if not data:
         return "No JSON", 400
 
-    event_type = data.get("event_type")
-    payload = data.get("payload")
+    if isinstance(data, dict):
+        events = data.get("events", [data])
+    else:
+        events = data
+
+    for ev in events:
+        if (not isinstance(ev, dict) or not isinstance(ev.get("event_id"), int)
+                or not ev.get("event_type") or not ev.get("payload")):
+            return "JSON incompleto", 400
+
+    _note_primary_event_id(request.headers.get("X-Primary-Event-Id", type=int))
+    try:
+        last_event_id = apply_events(events)
+    except EventGap as gap:
+        return jsonify({
+            "ok": False,
+            "error": "gap",
+            "last_event_id": gap.last_event_id,
+            "next_event_id": gap.next_event_id,
+        }), 409
+    return jsonify({"ok": True, "last_event_id": last_event_id})
 
-    if not event_type or not payload:
-        return "JSON incompleto", 400
 
-    apply_event(event_type, payload)
-    return jsonify({"ok": True})
+@app.route("/replica/media/<name>", methods=["GET"])
+def replica_media_state(name):
+    """Cuánto se ha recibido de un archivo (para reanudar el envío)."""
+    if not has_replication_secret(request):
+        return "No autorizado", 403
+    if not is_stored_name(name):
+        return "Nombre inválido", 400
+    offset, complete = transfer_offset(MEDIA_ROOT, name)
+    return jsonify({"offset": offset, "complete": complete})
+
+
+@app.route("/replica/media/<name>", methods=["PUT"])
+def replica_media_chunk(name):
+    """Un trozo del archivo en ?offset=N; al completarse se verifica su sha256.
+
+    Sólo el primario puede escribir: el sha256 de las variantes lo manda el
+    emisor (la réplica aún no tiene su fila en image_variants), así que sin el
+    secreto cualquiera podría publicar contenido con un nombre válido.
+    """
+    if not has_replication_secret(request):
+        return "No autorizado", 403
+    sha256 = request.headers.get("X-Content-SHA256", "")
+    try:
+        offset = int(request.args["offset"])
+        total = int(request.headers["X-Total-Size"])
+    except (KeyError, ValueError):
+        return "Faltan offset / X-Total-Size", 400
+    if not is_stored_name(name) or len(sha256) != 64:
+        return "Nombre o sha256 inválido", 400
+    if name.count(".") == 1 and name.split(".")[0] != sha256:
+        # los originales se llaman como su hash
+        return "El sha256 no coincide con el nombre", 400
+
+    received, complete = transfer_offset(MEDIA_ROOT, name)
+    if offset != received and not complete:
+        return jsonify({"offset": received, "complete": False}), 409
+    try:
+        received, complete = append_chunk(MEDIA_ROOT, name, offset, request.get_data(), total, sha256)
+    except ChecksumMismatch as e:
+        # se descartó lo recibido: el emisor vuelve a empezar desde 0
+        return jsonify({"offset": 0, "complete": False, "error": str(e)}), 422
+    return jsonify({"offset": received, "complete": complete})
+
+
+@app.route("/media/<name>")
+def media_file(name):
+    return send_media(name, MEDIA_ROOT)
+
+
+@app.route("/replica/status")
+def replica_status():
+    return jsonify({"replica": REPLICA_NAME, "last_event_id": get_last_event_id()})
 
 
 @app.route("/")
@@ -128,6 +527,12 @@ def home():
     return f"Replica activa: {REPLICA_NAME}", 200
 
 
+if PRIMARY_URL:
+    threading.Thread(
+        target=_catch_up_on_start, args=(PRIMARY_URL,), name="catch-up", daemon=True
+    ).start()
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5001))
     print(f"[{REPLICA_NAME}] Iniciando en puerto {port}...")
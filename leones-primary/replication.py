@@ -0,0 +1,246 @@
+"""Replicación asíncrona: un hilo lee events_log y lo envía a cada réplica."""
+import hmac
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from db_utils import get_connection
+from media import TRANSFER_CHUNK_SIZE, referenced_media
+
+# Secreto compartido entre el primario y sus réplicas (mismo valor en todos los procesos)
+REPLICATION_SECRET = os.environ.get("REPLICATION_SECRET", "cambia-este-secreto")
+SECRET_HEADER = "X-Replication-Secret"
+
+# Eventos que pueden apuntar a archivos de static/media
+MEDIA_EVENT_TYPES = ("CREATE_POST", "UPDATE_POST", "UPDATE_USER", "MEDIA_VARIANTS")
+
+BATCH_SECONDS = metrics.histogram(
+    "leones_replication_batch_seconds", "Duración de cada POST /replicate (incluye media)", ("replica",))
+EVENTS_SHIPPED = metrics.counter(
+    "leones_replication_events_total", "Eventos confirmados por cada réplica", ("replica",))
+FAILURES = metrics.counter(
+    "leones_replication_failures_total", "Lotes fallidos por réplica", ("replica",))
+LAG = metrics.gauge(
+    "leones_replication_lag_events", "Eventos del primario que la réplica aún no confirmó", ("replica",))
+
+
+def secret_headers():
+    return {SECRET_HEADER: REPLICATION_SECRET}
+
+
+def has_replication_secret(req):
+    """True si el request (de Flask) trae el secreto compartido: viene del primario o de una réplica."""
+    return hmac.compare_digest(req.headers.get(SECRET_HEADER, ""), REPLICATION_SECRET)
+
+
+def encode_batch(rows):
+    """Cuerpo de POST /replicate para filas (id, event_type, payload) de events_log."""
+    # el payload ya está serializado en events_log: se envía tal cual
+    return "[" + ",".join(
+        '{"event_id": %d, "event_type": %s, "payload": %s}' % (
+            r["id"], json.dumps(r["event_type"]), r["payload"]
+        )
+        for r in rows
+    ) + "]"
+
+
+class ReplicaTarget:
+    """Estado en memoria de una réplica: sesión keep-alive, ack y backoff."""
+
+    def __init__(self, url, acked_event_id):
+        self.url = url
+        self.acked_event_id = acked_event_id
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.last_error = None
+        # archivos de media que ya sabemos que la réplica tiene completos
+        self.shipped_media = set()
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        # la réplica sólo acepta eventos y media del primario (/replicate, /replica/media/<name>)
+        self.session.headers.update(secret_headers())
+
+
+class ReplicationWorker(threading.Thread):
+    """Outbox: los handlers sólo escriben en events_log y llaman a notify()."""
+
+    def __init__(self, db_path, replicas, batch_size=200, timeout=5,
+                 idle_interval=1.0, backoff_base=0.5, backoff_max=60.0, media_root=None):
+        super().__init__(name="replication-worker", daemon=True)
+        self.db_path = db_path
+        self.media_root = media_root
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.idle_interval = idle_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self.conn = get_connection(db_path)
+        self.targets = [ReplicaTarget(url, self._load_ack(url)) for url in replicas]
+        # último evento de events_log visto por el worker (para el lag y X-Primary-Event-Id)
+        self.head_event_id = self._head_event_id()
+        LAG.set_function(lambda: {
+            (t.url,): max(0, self.head_event_id - t.acked_event_id) for t in self.targets
+        })
+
+    # -------------------------------
+    # Estado persistido por réplica
+    # -------------------------------
+    def _load_ack(self, url):
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT last_acked_event_id FROM replication_state WHERE replica_url = ?",
+            (url,)
+        )
+        row = cur.fetchone()
+        return row["last_acked_event_id"] if row else 0
+
+    def _save_ack(self, target):
+        self.conn.execute(
+            """
+            INSERT INTO replication_state (replica_url, last_acked_event_id, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(replica_url) DO UPDATE SET
+                last_acked_event_id = excluded.last_acked_event_id,
+                updated_at = excluded.updated_at
+            """,
+            (target.url, target.acked_event_id)
+        )
+        self.conn.commit()
+
+    # -------------------------------
+    # Bucle principal
+    # -------------------------------
+    def notify(self):
+        """Despierta al worker tras confirmar un evento en events_log."""
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def _head_event_id(self):
+        return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM events_log").fetchone()[0]
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wake.clear()
+            self.head_event_id = self._head_event_id()
+            pending = False
+            for target in self.targets:
+                if time.monotonic() < target.next_attempt:
+                    continue
+                try:
+                    pending = self._replicate_batch(target) or pending
+                except Exception as e:
+                    self._mark_failure(target, e)
+            if pending:
+                continue
+            self._wake.wait(self._next_wait())
+
+    def _next_wait(self):
+        now = time.monotonic()
+        waits = [t.next_attempt - now for t in self.targets if t.next_attempt > now]
+        return max(0.0, min(waits + [self.idle_interval]))
+
+    def _pending_events(self, after_id):
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT id, event_type, payload FROM events_log WHERE id > ? ORDER BY id ASC LIMIT ?",
+            (after_id, self.batch_size)
+        )
+        return cur.fetchall()
+
+    def _replicate_batch(self, target):
+        """Envía un lote a la réplica. True si puede quedar más pendiente."""
+        rows = self._pending_events(target.acked_event_id)
+        if not rows:
+            return False
+        started = time.perf_counter()
+        # los archivos van antes que los eventos que los usan
+        self._ship_media(target, rows)
+        resp = target.session.post(
+            f"{target.url}/replicate",
+            data=encode_batch(rows),
+            headers={
+                "Content-Type": "application/json",
+                "X-Primary-Event-Id": str(max(self.head_event_id, rows[-1]["id"])),
+            },
+            timeout=self.timeout,
+        )
+        BATCH_SECONDS.observe(time.perf_counter() - started, replica=target.url)
+        if resp.status_code == 409:
+            # la réplica tiene un hueco (o se reinició): reanudamos desde su posición
+            replica_position = resp.json()["last_event_id"]
+            if replica_position == target.acked_event_id:
+                raise RuntimeError(f"events_log no continúa tras el evento {replica_position}")
+            target.acked_event_id = replica_position
+            self._save_ack(target)
+            return True
+        resp.raise_for_status()
+        acked = resp.json()["last_event_id"]
+        EVENTS_SHIPPED.inc(max(0, acked - target.acked_event_id), replica=target.url)
+        target.acked_event_id = acked
+        self._save_ack(target)
+        target.failures = 0
+        target.next_attempt = 0.0
+        target.last_error = None
+        return len(rows) == self.batch_size
+
+    # -------------------------------
+    # Archivos de media
+    # -------------------------------
+    def _ship_media(self, target, rows):
+        """Copia a la réplica los archivos que usan estos eventos y que aún no tiene."""
+        if not self.media_root:
+            return
+        for r in rows:
+            if r["event_type"] not in MEDIA_EVENT_TYPES:
+                continue
+            for name, sha256 in referenced_media(r["event_type"], json.loads(r["payload"])):
+                if name not in target.shipped_media:
+                    self._send_file(target, name, sha256)
+                    target.shipped_media.add(name)
+
+    def _send_file(self, target, name, sha256):
+        """Envío por trozos reanudable: la réplica dice cuánto tiene y se sigue desde ahí."""
+        path = os.path.join(self.media_root, name)
+        if not os.path.exists(path):
+            # ya se recolectó porque nada lo usa; el evento se aplica igual
+            return
+        url = f"{target.url}/replica/media/{name}"
+        resp = target.session.get(url, timeout=self.timeout)
+        resp.raise_for_status()
+        state = resp.json()
+        total = os.path.getsize(path)
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "X-Total-Size": str(total),
+            "X-Content-SHA256": sha256,
+        }
+        with open(path, "rb") as f:
+            while not state["complete"]:
+                f.seek(state["offset"])
+                chunk = f.read(TRANSFER_CHUNK_SIZE)
+                resp = target.session.put(
+                    url, params={"offset": state["offset"]}, data=chunk,
+                    headers=headers, timeout=self.timeout,
+                )
+                if resp.status_code != 409:
+                    # 409: la réplica tenía otro offset y lo devuelve para reanudar
+                    resp.raise_for_status()
+                state = resp.json()
+
+    def _mark_failure(self, target, error):
+        FAILURES.inc(replica=target.url)
+        target.failures += 1
+        target.last_error = str(error)
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (target.failures - 1)))
+        target.next_attempt = time.monotonic() + delay
@@ -0,0 +1,270 @@
+"""Router HTTP delante del primario y las réplicas.
+
+Las escrituras (y todo lo que sólo sirve el primario: páginas HTML, login,
+SSE, /sync) van al primario. Los GET de la API de lectura y de /media van a
+la réplica sana menos cargada cuyo retraso no pase de MAX_LAG eventos.
+
+Tras una escritura el primario responde con X-Event-Id; el router lo guarda
+en la cookie PIN_COOKIE y, mientras dure, sólo usa réplicas que ya aplicaron
+ese evento (y además les pide min_event_id), o el primario.
+"""
+import os
+import threading
+import time
+
+import requests
+from flask import Flask, Response, jsonify, request
+from requests.adapters import HTTPAdapter
+
+PRIMARY_URL = os.environ.get("PRIMARY_URL", "http://localhost:5000").rstrip("/")
+REPLICAS = [
+    url.strip().rstrip("/")
+    for url in os.environ.get("REPLICAS", "http://localhost:5001,http://localhost:5002").split(",")
+    if url.strip()
+]
+
+# Retraso máximo (en eventos) para que una réplica reciba lecturas
+MAX_LAG = int(os.environ.get("MAX_LAG", 50))
+
+# Segundos entre chequeos de salud
+HEALTH_INTERVAL = float(os.environ.get("HEALTH_INTERVAL", 1.0))
+
+# Tras escribir, durante cuántos segundos se exige leer al menos lo escrito
+PIN_SECONDS = 10
+PIN_COOKIE = "leones_min_event"
+
+CONNECT_TIMEOUT = 3
+# holgado para SSE (el primario manda un latido cada 15 s)
+READ_TIMEOUT = 60
+
+# Rutas que las réplicas saben servir
+REPLICA_READ_PREFIXES = (
+    "/api/timeline", "/api/profile/", "/api/posts/", "/api/search", "/api/reactions_summary", "/media/",
+)
+
+HOP_BY_HOP = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "host",
+}
+
+
+class Backend:
+    """Un servidor detrás del router: salud, event_id aplicado y carga."""
+
+    def __init__(self, url, role):
+        self.url = url
+        self.role = role
+        self.healthy = False
+        self.event_id = 0
+        self.in_flight = 0
+        self.served = 0
+        self.errors = 0
+        self.last_check = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=64))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=64))
+
+    @property
+    def status_path(self):
+        return "/primary/status" if self.role == "primary" else "/replica/status"
+
+    def acquire(self):
+        with self._lock:
+            self.in_flight += 1
+            self.served += 1
+
+    def release(self, error=None):
+        with self._lock:
+            self.in_flight -= 1
+            if error is not None:
+                self.errors += 1
+                self.last_error = str(error)
+
+
+class Router:
+    def __init__(self, primary_url, replica_urls, max_lag=MAX_LAG):
+        self.primary = Backend(primary_url, "primary")
+        self.replicas = [Backend(url, "replica") for url in replica_urls]
+        self.max_lag = max_lag
+        self._lock = threading.Lock()
+        self.routed = {}
+
+    def lag(self, backend):
+        return max(0, self.primary.event_id - backend.event_id)
+
+    # -------------------------------
+    # Salud
+    # -------------------------------
+    def check_health(self):
+        for backend in [self.primary] + self.replicas:
+            try:
+                resp = backend.session.get(backend.url + backend.status_path, timeout=CONNECT_TIMEOUT)
+                resp.raise_for_status()
+                backend.event_id = resp.json()["last_event_id"]
+                backend.healthy = True
+            except Exception as e:
+                backend.healthy = False
+                backend.last_error = str(e)
+            backend.last_check = time.time()
+
+    # -------------------------------
+    # Elección de servidor
+    # -------------------------------
+    def choose(self, method, path, min_event_id=None):
+        """(backend, motivo) para un request."""
+        if method not in ("GET", "HEAD"):
+            return self.primary, "write"
+        if not path.startswith(REPLICA_READ_PREFIXES):
+            return self.primary, "primary_only"
+        candidates = [
+            r for r in self.replicas
+            if r.healthy and self.lag(r) <= self.max_lag
+            and (min_event_id is None or r.event_id >= min_event_id)
+        ]
+        if not candidates:
+            return self.primary, "pinned" if min_event_id is not None else "no_replica"
+        return min(candidates, key=lambda r: (r.in_flight, r.served)), "replica"
+
+    def count(self, reason):
+        with self._lock:
+            self.routed[reason] = self.routed.get(reason, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            routed = dict(self.routed)
+        return {
+            "max_lag": self.max_lag,
+            "routed": routed,
+            "backends": [
+                {
+                    "url": b.url,
+                    "role": b.role,
+                    "healthy": b.healthy,
+                    "event_id": b.event_id,
+                    "lag": self.lag(b),
+                    "in_flight": b.in_flight,
+                    "served": b.served,
+                    "errors": b.errors,
+                    "last_check": b.last_check,
+                    "last_error": b.last_error,
+                }
+                for b in [self.primary] + self.replicas
+            ],
+        }
+
+
+class HealthChecker(threading.Thread):
+    def __init__(self, router, interval=HEALTH_INTERVAL):
+        super().__init__(name="router-health", daemon=True)
+        self.router = router
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            self.router.check_health()
+            self._stopping.wait(self.interval)
+
+
+app = Flask(__name__)
+
+router = Router(PRIMARY_URL, REPLICAS)
+router.check_health()
+health_checker = HealthChecker(router)
+health_checker.start()
+
+
+def _min_event_id():
+    """El mayor entre la cookie de la última escritura y ?min_event_id."""
+    values = [request.cookies.get(PIN_COOKIE, type=int), request.args.get("min_event_id", type=int)]
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def _forward(backend, params):
+    """Reenvía el request tal cual; la respuesta queda abierta (stream) y contando en in_flight."""
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP}
+    # se reemplaza (no se agrega) el que mande el cliente: el primario confía en este valor
+    headers["X-Forwarded-For"] = request.remote_addr
+    headers["X-Forwarded-Host"] = request.host
+    backend.acquire()
+    try:
+        upstream = backend.session.request(
+            request.method,
+            backend.url + request.path,
+            params=params,
+            data=request.get_data(),
+            headers=headers,
+            stream=True,
+            allow_redirects=False,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        )
+    except requests.RequestException as e:
+        backend.release(e)
+        raise
+    return upstream
+
+
+def _discard(backend, upstream):
+    upstream.close()
+    backend.release()
+
+
+def _stream(backend, upstream):
+    """Respuesta de Flask que va pasando el cuerpo a medida que llega."""
+
+    # iter_content ya descomprime: no se reenvían Content-Encoding / Content-Length
+    drop = HOP_BY_HOP | ({"content-encoding", "content-length"} if "Content-Encoding" in upstream.headers else set())
+    out_headers = [(k, v) for k, v in upstream.raw.headers.items() if k.lower() not in drop]
+    resp = Response(upstream.iter_content(chunk_size=None), status=upstream.status_code, headers=out_headers)
+    # se libera aunque el cliente corte antes de leer el cuerpo
+    resp.call_on_close(lambda: _discard(backend, upstream))
+    return resp
+
+
+@app.route("/router/stats")
+def router_stats():
+    return jsonify(router.stats())
+
+
+@app.route("/", defaults={"path": ""}, methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE"])
+@app.route("/<path:path>", methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE"])
+def proxy(path):
+    min_event_id = _min_event_id()
+    backend, reason = router.choose(request.method, request.path, min_event_id)
+    params = list(request.args.items(multi=True))
+
+    if backend is not router.primary:
+        replica_params = [(k, v) for k, v in params if k != "min_event_id"]
+        if min_event_id is not None:
+            replica_params.append(("min_event_id", str(min_event_id)))
+        try:
+            upstream = _forward(backend, replica_params)
+            if upstream.status_code != 503:
+                router.count("replica")
+                return _stream(backend, upstream)
+            # réplica atrasada respecto a min_event_id: el primario siempre está al día
+            _discard(backend, upstream)
+        except requests.RequestException:
+            backend.healthy = False
+        backend, reason = router.primary, "replica_retry"
+
+    router.count(reason)
+    try:
+        upstream = _forward(backend, params)
+    except requests.RequestException as e:
+        return jsonify({"error": "primario no disponible", "detail": str(e)}), 502
+    resp = _stream(backend, upstream)
+    written = upstream.headers.get("X-Event-Id")
+    if reason == "write" and written:
+        resp.set_cookie(PIN_COOKIE, written, max_age=PIN_SECONDS, httponly=True, samesite="Lax")
+    return resp
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8000)), threaded=True)
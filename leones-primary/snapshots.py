@@ -0,0 +1,140 @@
+"""Snapshots consistentes de la BD del primario y compactación de events_log."""
+import os
+import sqlite3
+import threading
+
+from db_utils import get_connection
+from media import collect_unreferenced
+
+SNAPSHOT_DIR = os.path.join("db", "snapshots")
+
+# Tablas que sólo tienen sentido en el primario y no viajan en el snapshot
+PRIMARY_ONLY_TABLES = ("events_log", "replication_state", "snapshots")
+
+
+def last_event_id(conn):
+    """Último id asignado en events_log (aunque la fila ya esté compactada)."""
+    cur = conn.cursor()
+    cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'events_log'")
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def create_snapshot(conn, snapshot_dir=SNAPSHOT_DIR):
+    """Copia la BD con la API de backup y la etiqueta con el evento que cubre.
+
+    El snapshot lleva users/posts/reactions/comments y replica_meta.last_event_id
+    ya fijado, así que una réplica nueva puede usarlo tal cual como su BD.
+    Los hashes de contraseña se vacían: las réplicas no autentican.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    tmp_path = os.path.join(snapshot_dir, "snapshot.tmp")
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    dest = sqlite3.connect(tmp_path)
+    try:
+        conn.backup(dest)
+        event_id = last_event_id(dest)
+        for table in PRIMARY_ONLY_TABLES:
+            dest.execute(f"DELETE FROM {table}")
+        dest.execute("UPDATE users SET password_hash = ''")
+        dest.execute(
+            """
+            INSERT INTO replica_meta (key, value) VALUES ('last_event_id', ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """,
+            (str(event_id),)
+        )
+        dest.commit()
+        dest.execute("VACUUM")
+    finally:
+        dest.close()
+
+    filename = f"snapshot_{event_id:012d}.db"
+    os.replace(tmp_path, os.path.join(snapshot_dir, filename))
+    conn.execute(
+        "INSERT OR REPLACE INTO snapshots (event_id, filename) VALUES (?, ?)",
+        (event_id, filename)
+    )
+    conn.commit()
+    return event_id, filename
+
+
+def latest_snapshot(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT event_id, filename FROM snapshots ORDER BY event_id DESC LIMIT 1")
+    row = cur.fetchone()
+    return dict(row) if row else None
+
+
+def compact(conn, replica_urls, snapshot_dir=SNAPSHOT_DIR):
+    """Borra el log cubierto por el snapshot más reciente que todas las réplicas ya confirmaron.
+
+    Los snapshots anteriores a ése dejan de servir (su cola de eventos ya no
+    existe) y también se eliminan. Devuelve el event_id hasta el que se compactó.
+    """
+    cur = conn.cursor()
+    acked = []
+    for url in replica_urls:
+        cur.execute(
+            "SELECT last_acked_event_id FROM replication_state WHERE replica_url = ?",
+            (url,)
+        )
+        row = cur.fetchone()
+        acked.append(row["last_acked_event_id"] if row else 0)
+    safe_id = min(acked) if acked else last_event_id(conn)
+
+    cur.execute(
+        "SELECT event_id FROM snapshots WHERE event_id <= ? ORDER BY event_id DESC LIMIT 1",
+        (safe_id,)
+    )
+    row = cur.fetchone()
+    if not row:
+        return 0
+    through = row["event_id"]
+
+    cur.execute("SELECT filename FROM snapshots WHERE event_id < ?", (through,))
+    stale = [r["filename"] for r in cur.fetchall()]
+    cur.execute("DELETE FROM events_log WHERE id <= ?", (through,))
+    cur.execute("DELETE FROM snapshots WHERE event_id < ?", (through,))
+    conn.commit()
+
+    for filename in stale:
+        try:
+            os.remove(os.path.join(snapshot_dir, filename))
+        except FileNotFoundError:
+            pass
+    return through
+
+
+class SnapshotWorker(threading.Thread):
+    """Cada `interval` segundos toma un snapshot (si hubo eventos nuevos) y compacta.
+
+    Con `media_root` también borra los archivos de media sin referencias.
+    """
+
+    def __init__(self, db_path, replica_urls, interval, snapshot_dir=SNAPSHOT_DIR, media_root=None):
+        super().__init__(name="snapshot-worker", daemon=True)
+        self.db_path = db_path
+        self.replica_urls = replica_urls
+        self.interval = interval
+        self.snapshot_dir = snapshot_dir
+        self.media_root = media_root
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        conn = get_connection(self.db_path)
+        while not self._stopping.wait(self.interval):
+            try:
+                latest = latest_snapshot(conn)
+                if latest is None or latest["event_id"] < last_event_id(conn):
+                    create_snapshot(conn, self.snapshot_dir)
+                compact(conn, self.replica_urls, self.snapshot_dir)
+                if self.media_root:
+                    collect_unreferenced(conn, self.media_root)
+            except Exception as e:
+                print("[snapshots] error:", e)
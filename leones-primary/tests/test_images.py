@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+PIL = pytest.importorskip("PIL")
+pillow_heif = pytest.importorskip("pillow_heif")
+
+from PIL import Image  # noqa: E402
+
+from images import VARIANTS, ImageProcessor  # noqa: E402
+
+
+def test_heic_upload_gets_jpeg_variants(tmp_path):
+    source = "media/" + "a" * 64 + ".heic"
+    os.makedirs(tmp_path / "media")
+    pillow_heif.from_pillow(Image.new("RGB", (2000, 1500), "green")).save(tmp_path / source, quality=80)
+
+    processor = ImageProcessor(db=None, static_root=str(tmp_path))
+    try:
+        variants = {name: (filename, w, h) for name, filename, w, h, _ in processor._render_variants(source)}
+    finally:
+        processor.executor.shutdown()
+
+    assert set(variants) == {"thumb", "display"}
+    for name, (filename, w, h) in variants.items():
+        assert filename == ImageProcessor.variant_filename(source, name)
+        assert max(w, h) == VARIANTS[name]
+        with Image.open(tmp_path / filename) as im:
+            assert im.format == "JPEG"
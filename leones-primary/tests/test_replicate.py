@@ -0,0 +1,46 @@
+import importlib
+import os
+
+import pytest
+
+from replication import encode_batch, secret_headers
+
+
+@pytest.fixture(scope="module")
+def replica(tmp_path_factory):
+    """replica_server con su BD en un directorio temporal (se importa una sola vez: registra métricas)."""
+    root = tmp_path_factory.mktemp("replica")
+    os.makedirs(root / "db")
+    cwd = os.getcwd()
+    os.chdir(root)
+    os.environ["REPLICA_NAME"] = "test-replica"
+    try:
+        yield importlib.import_module("replica_server")
+    finally:
+        os.chdir(cwd)
+
+
+def _batch(event_id):
+    return encode_batch([{
+        "id": event_id,
+        "event_type": "CREATE_USER",
+        "payload": '{"user_id": 99, "username": "intruso", "role": "admin"}',
+    }])
+
+
+def test_unsigned_batch_is_rejected(replica):
+    client = replica.app.test_client()
+    before = replica.get_last_event_id()
+    resp = client.post("/replicate", data=_batch(before + 1), headers={"Content-Type": "application/json"})
+    assert resp.status_code == 403
+    assert replica.get_last_event_id() == before
+    assert replica.db.reader().execute("SELECT 1 FROM users WHERE username = 'intruso'").fetchone() is None
+
+
+def test_signed_batch_is_applied(replica):
+    client = replica.app.test_client()
+    before = replica.get_last_event_id()
+    resp = client.post("/replicate", data=_batch(before + 1),
+                       headers={"Content-Type": "application/json", **secret_headers()})
+    assert resp.status_code == 200
+    assert replica.get_last_event_id() == before + 1
@@ -0,0 +1,47 @@
+"""Caché en proceso de filas de users (LRU con TTL)."""
+import threading
+import time
+from collections import OrderedDict
+
+# Eventos de events_log que modifican una fila de users
+USER_EVENT_TYPES = ("CREATE_USER", "UPDATE_USER")
+
+
+class UserCache:
+    """Filas de users por id. Se invalida explícitamente al cambiar un usuario;
+    el TTL sólo acota cuánto puede durar una entrada si se pierde un aviso."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self._data.pop(user_id, None)
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, user_id, user):
+        with self._lock:
+            self._data[user_id] = (time.monotonic() + self.ttl, dict(user))
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def on_event(self, event_id, event_type, payload):
+        """Listener de events_log: descarta al usuario tocado por el evento."""
+        if event_type in USER_EVENT_TYPES:
+            self.invalidate(payload.get("user_id"))